@@ -39,6 +39,18 @@ resource "aws_api_gateway_resource" "topics_name" {
   path_part   = "{name}"
 }
 
+resource "aws_api_gateway_resource" "history" {
+  rest_api_id = aws_api_gateway_rest_api.chat.id
+  parent_id   = aws_api_gateway_rest_api.chat.root_resource_id
+  path_part   = "history"
+}
+
+resource "aws_api_gateway_resource" "history_name" {
+  rest_api_id = aws_api_gateway_rest_api.chat.id
+  parent_id   = aws_api_gateway_resource.history.id
+  path_part   = "{name}"
+}
+
 resource "aws_api_gateway_method" "create_message" {
   rest_api_id   = aws_api_gateway_rest_api.chat.id
   resource_id   = aws_api_gateway_resource.messages.id
@@ -68,6 +80,17 @@ resource "aws_api_gateway_method" "get_topic" {
   }
 }
 
+resource "aws_api_gateway_method" "get_history" {
+  rest_api_id   = aws_api_gateway_rest_api.chat.id
+  resource_id   = aws_api_gateway_resource.history_name.id
+  http_method   = "GET"
+  authorization = "NONE"
+
+  request_parameters = {
+    "method.request.path.name" = true
+  }
+}
+
 resource "aws_api_gateway_method" "get_asset" {
   rest_api_id   = aws_api_gateway_rest_api.chat.id
   resource_id   = aws_api_gateway_resource.asset_name.id
@@ -136,6 +159,20 @@ resource "aws_api_gateway_integration" "get_topic" {
   }
 }
 
+resource "aws_api_gateway_integration" "get_history" {
+  rest_api_id = aws_api_gateway_rest_api.chat.id
+  resource_id = aws_api_gateway_resource.history_name.id
+  http_method = aws_api_gateway_method.get_history.http_method
+  credentials = aws_iam_role.api_gateway_sqs_role.arn
+
+  integration_http_method = "GET"
+  type                    = "AWS"
+  uri                     = "arn:aws:apigateway:${data.aws_region.current.name}:s3:path/${data.terraform_remote_state.oob.outputs.bucket_name}/history/{name}"
+  request_parameters = {
+    "integration.request.path.name" = "method.request.path.name"
+  }
+}
+
 resource "aws_api_gateway_integration" "get_asset" {
   rest_api_id = aws_api_gateway_rest_api.chat.id
   resource_id = aws_api_gateway_resource.asset_name.id
@@ -183,6 +220,17 @@ resource "aws_api_gateway_method_response" "get_topic_200" {
   }
 }
 
+resource "aws_api_gateway_method_response" "get_history_200" {
+  rest_api_id = aws_api_gateway_rest_api.chat.id
+  resource_id = aws_api_gateway_resource.history_name.id
+  http_method = aws_api_gateway_method.get_history.http_method
+  status_code = "200"
+
+  response_parameters = {
+    "method.response.header.Content-Type" = true
+  }
+}
+
 resource "aws_api_gateway_method_response" "get_asset_200" {
   rest_api_id = aws_api_gateway_rest_api.chat.id
   resource_id = aws_api_gateway_resource.asset_name.id
@@ -235,6 +283,21 @@ resource "aws_api_gateway_integration_response" "get_topic_200" {
   ]
 }
 
+resource "aws_api_gateway_integration_response" "get_history_200" {
+  rest_api_id = aws_api_gateway_rest_api.chat.id
+  resource_id = aws_api_gateway_resource.history_name.id
+  http_method = aws_api_gateway_method.get_history.http_method
+  status_code = aws_api_gateway_method_response.get_history_200.status_code
+
+  response_parameters = {
+    "method.response.header.Content-Type" = "integration.response.header.Content-Type"
+  }
+
+  depends_on = [
+    aws_api_gateway_integration.get_history
+  ]
+}
+
 resource "aws_api_gateway_integration_response" "get_asset_200" {
   rest_api_id = aws_api_gateway_rest_api.chat.id
   resource_id = aws_api_gateway_resource.asset_name.id
@@ -306,22 +369,28 @@ resource "aws_api_gateway_deployment" "chat" {
       aws_api_gateway_resource.topics.id,
       aws_api_gateway_resource.messages_name.id,
       aws_api_gateway_resource.topics_name.id,
+      aws_api_gateway_resource.history.id,
+      aws_api_gateway_resource.history_name.id,
       aws_api_gateway_method.create_message.id,
       aws_api_gateway_method.get_message.id,
       aws_api_gateway_method.get_topic.id,
+      aws_api_gateway_method.get_history.id,
       aws_api_gateway_method.get_asset.id,
       aws_api_gateway_method.get_root.id,
       aws_api_gateway_integration.create_message.id,
       aws_api_gateway_integration.get_message.id,
       aws_api_gateway_integration.get_topic.id,
+      aws_api_gateway_integration.get_history.id,
       aws_api_gateway_integration.get_asset.id,
       aws_api_gateway_integration.get_root.id,
       aws_api_gateway_method_response.get_message_200.id,
       aws_api_gateway_method_response.get_topic_200.id,
+      aws_api_gateway_method_response.get_history_200.id,
       aws_api_gateway_method_response.get_asset_200.id,
       aws_api_gateway_method_response.get_root_200.id,
       aws_api_gateway_integration_response.get_message_200.id,
       aws_api_gateway_integration_response.get_topic_200.id,
+      aws_api_gateway_integration_response.get_history_200.id,
       aws_api_gateway_integration_response.get_asset_200.id,
       aws_api_gateway_integration_response.get_root_200.id,
       aws_api_gateway_method_response.create_message_200.id,
@@ -461,3 +530,7 @@ output "read_url" {
 output "read_topic_url" {
   value = "${aws_api_gateway_stage.prod.invoke_url}/topics/{name}"
 }
+
+output "read_history_url" {
+  value = "${aws_api_gateway_stage.prod.invoke_url}/history/{name}"
+}
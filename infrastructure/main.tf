@@ -65,6 +65,7 @@ resource "aws_iam_role_policy" "chat_service_policy" {
         Action = [
           "dynamodb:GetItem",
           "dynamodb:PutItem",
+          "dynamodb:UpdateItem",
           "dynamodb:DeleteItem"
         ],
         Resource = "${aws_dynamodb_table.locking_table.arn}"
@@ -74,6 +75,7 @@ resource "aws_iam_role_policy" "chat_service_policy" {
         Action = [
           "sqs:ReceiveMessage",
           "sqs:DeleteMessage",
+          "sqs:ChangeMessageVisibility",
           "sqs:GetQueueAttributes"
         ],
         Resource = "${aws_sqs_queue.chat_service_queue.arn}"
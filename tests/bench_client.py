@@ -0,0 +1,268 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Copyright 2024 Robert D. French
+"""
+Chat Client Latency Benchmark
+
+Runs the daemon's HTTP server (ChatServer) against the local backend,
+fills it with pre-signed traffic from synthetic ed25519 signers, and
+points a number of headless chat clients at it. Each client follows its
+topics the same way `pubkey.chat chat` does (TopicSubscription, driven
+by a PollScheduler), but renders into memory instead of onto a screen.
+
+We report how long a client takes to show the first message of a topic
+it joins, and to catch up on a backlog of 10, 100 and 1000 messages;
+how long new messages take to reach every client; and how many requests
+each client makes per minute while following a live topic. Both plain
+polling and long polling are measured.
+
+    python3 -m tests.bench_client --clients 8 --live 20 --interval 0.5
+"""
+import argparse
+import tempfile
+import threading
+import time
+import typing
+from . import pkc
+from .bench_daemon import make_signers, percentile
+
+
+class HeadlessUI:
+    """
+    Stands in for ChatUI, noting when each message arrives instead of
+    drawing it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.arrivals: typing.List[typing.Tuple[float, str]] = []
+
+    def chatbuffer_add(self, msg: str, topic: typing.Optional[str] = None):
+        with self.lock:
+            self.arrivals.append((time.perf_counter(), msg))
+
+
+class Client:
+    """
+    One headless chat client: its own connection, scheduler and
+    (in-memory) screen, counting every request it makes.
+    """
+    def __init__(self, url: str, longpoll: bool):
+        self.ui = HeadlessUI()
+        self.requests = 0
+        rest_client = pkc.RestClient()
+        request = rest_client.request
+
+        def counted(*args, **kwargs):
+            self.requests += 1
+            return request(*args, **kwargs)
+        rest_client.request = counted  # type: ignore
+        self.api = pkc.ChatAPIClient(
+            url, rest_client, longpoll_url=url if longpoll else None)
+        self.scheduler = pkc.PollScheduler(self.api)
+        self.subscriptions: typing.Dict[str, pkc.TopicSubscription] = {}
+        threading.Thread(target=self.scheduler, daemon=True).start()
+
+    def join(self, topic: str):
+        subscription = pkc.TopicSubscription(
+            pkc.Topic(topic), self.ui, pkc.ChatPointer(pkc.Topic(topic)),
+            self.api)
+        self.subscriptions[topic] = subscription
+        self.scheduler.subscribe(subscription)
+        if self.api.longpoll_url:
+            # As in chat_main: the scheduler may already be in the
+            # middle of a long poll which doesn't include this topic.
+            threading.Thread(
+                target=self.scheduler.poll, args=[topic], daemon=True).start()
+
+    def at(self, topic: str) -> str:
+        return self.subscriptions[topic].ptr.parent
+
+    def stop(self):
+        self.scheduler.stop()
+
+
+def make_chain(
+        signers: typing.List[pkc.PrivateKey],
+        topic: str,
+        count: int,
+        parent: str = "") -> typing.List[pkc.SignedMessage]:
+    """
+    Sign `count` messages to `topic`, round-robin across signers, each
+    naming the one before it as its parent.
+    """
+    chain = []
+    for i in range(count):
+        interior = pkc.InteriorMessage(pkc.Topic(topic), parent, f"{i}")
+        message = signers[i % len(signers)].sign_data(
+            interior.dumps().encode())
+        parent = message.digest()
+        chain.append(message)
+    return chain
+
+
+def wait_until(
+        condition: typing.Callable[[], bool],
+        timeout: float) -> bool:
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def summarize(samples: typing.List[float]) -> str:
+    if not samples:
+        return f"{'-':>10}{'-':>10}"
+    ordered = sorted(samples)
+    return (f"{percentile(ordered, 0.50) * 1000:>10.1f}"
+            f"{percentile(ordered, 0.99) * 1000:>10.1f}")
+
+
+def bench_join(
+        url: str,
+        longpoll: bool,
+        clients: int,
+        backlogs: typing.Dict[int, str]):
+    """
+    For each backlog, have every client join its topic at once, and time
+    how long each takes to show the first message, and to catch up.
+    """
+    print(f"{'join':<12}{'first p50':>10}{'first p99':>10}"
+          f"{'done p50':>10}{'done p99':>10}{'shown':>8}{'requests':>10}")
+    for size, head in backlogs.items():
+        topic = f"backlog-{size}"
+        crowd = [Client(url, longpoll) for _ in range(clients)]
+        start = time.perf_counter()
+        for client in crowd:
+            client.join(topic)
+        first, done = [], []
+        for client in crowd:
+            if wait_until(lambda: client.at(topic) == head, 120):
+                done.append(time.perf_counter() - start)
+            if client.ui.arrivals:
+                first.append(client.ui.arrivals[0][0] - start)
+            client.stop()
+        shown = sum(len(c.ui.arrivals) for c in crowd) / clients
+        requests = sum(c.requests for c in crowd) / clients
+        print(f"{size:<12}{summarize(first)}{summarize(done)}"
+              f"{shown:>8.0f}{requests:>10.1f}")
+
+
+def bench_live(
+        url: str,
+        longpoll: bool,
+        clients: int,
+        bucket: pkc.PublicChatBucket,
+        traffic: typing.List[pkc.SignedMessage],
+        interval: float):
+    """
+    Have every client follow a live topic, post `traffic` to it one
+    message every `interval` seconds, and time how long each message
+    takes to reach each client.
+    """
+    topic = str(traffic[0].interior().topic)
+    crowd = [Client(url, longpoll) for _ in range(clients)]
+    for client in crowd:
+        client.join(topic)
+    # The topic starts out empty, so each client is up to date as soon
+    # as it has looked once. Only count requests from then on.
+    for client in crowd:
+        wait_until(lambda: client.requests > 0, 10)
+    time.sleep(interval)
+    for client in crowd:
+        client.requests = 0
+
+    sent: typing.Dict[str, float] = {}
+    start = time.perf_counter()
+    for message in traffic:
+        sent[message.interior().text] = time.perf_counter()
+        bucket.write_message(message)
+        time.sleep(interval)
+    head = traffic[-1].digest()
+    for client in crowd:
+        wait_until(lambda: client.at(topic) == head, 120)
+    elapsed = time.perf_counter() - start
+    for client in crowd:
+        client.stop()
+
+    latencies = []
+    missed = 0
+    for client in crowd:
+        arrived = {msg.partition(": ")[2]: t for t, msg in client.ui.arrivals}
+        for text, t in sent.items():
+            if text in arrived:
+                latencies.append(arrived[text] - t)
+            else:
+                missed += 1
+    per_minute = sum(c.requests for c in crowd) / clients / elapsed * 60
+    print(f"{'notify p50 ms':<24}{summarize(latencies)[:10]:>10}")
+    print(f"{'notify p99 ms':<24}{summarize(latencies)[10:]:>10}")
+    print(f"{'requests/client-minute':<24}{per_minute:>10.1f}")
+    if missed:
+        print(f"warning: {missed} deliveries never arrived")
+
+
+def run(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Signing traffic from {args.signers} ed25519 signers...")
+        signers = make_signers(directory, args.signers, "ed25519")
+        backlogs = {
+            size: make_chain(signers, f"backlog-{size}", size)
+            for size in args.backlogs
+        }
+        live = {
+            mode: make_chain(signers, f"live-{mode}", args.live)
+            for mode in args.modes
+        }
+    # Keep the signers' keys for the whole run, rather than having the
+    # clients go looking for them on GitHub.
+    pkc.KEY_CACHE.configure(24 * 60 * 60, pkc.DEFAULT_KEY_CACHE_SIZE)
+
+    config = pkc.DaemonConfig(
+        "local", "bucket", "table", "queue", backend="local")
+    lock_table, s3, sqs = config.connect()
+    lock = pkc.TopicLock(
+        lock_table, config.lease_seconds, config.lease_idle_seconds)
+    lock.start()
+    watch = pkc.TopicWatch()
+    bucket = pkc.PublicChatBucket(s3, lock, watch=watch)
+    for chain in backlogs.values():
+        for message in chain:
+            bucket.write_message(message)
+    server = pkc.ChatServer(("127.0.0.1", 0), bucket, watch, sqs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    heads = {size: chain[-1].digest() for size, chain in backlogs.items()}
+    for mode in args.modes:
+        print()
+        print(f"== {mode}, {args.clients} clients ==")
+        longpoll = mode == "long-poll"
+        bench_join(url, longpoll, args.clients, heads)
+        print()
+        bench_live(
+            url, longpoll, args.clients, bucket, live[mode], args.interval)
+    server.shutdown()
+    server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--signers', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--backlogs', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--live', type=int, default=20,
+                        help='messages to post while clients follow along')
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between live messages')
+    parser.add_argument('--modes', nargs='+', choices=['poll', 'long-poll'],
+                        default=['poll', 'long-poll'])
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
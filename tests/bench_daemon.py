@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Copyright 2024 Robert D. French
+"""
+Daemon Throughput Benchmark
+
+Drives the daemon's hot path (receive, verify, write, acknowledge)
+against the local backend, so no AWS account is needed. Synthetic
+signers post chains of chat messages to a handful of topics, and we
+report overall messages per second along with per-stage latencies.
+
+    python3 -m tests.bench_daemon --signers 8 --topics 4 --messages 200
+"""
+import argparse
+import collections
+import contextlib
+import os
+import pathlib
+import subprocess
+import tempfile
+import time
+import typing
+from . import pkc
+
+
+class Stopwatch:
+    """
+    Collects latency samples (in seconds) for each named stage.
+    """
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def wrap(self, stage: str, func: typing.Callable) -> typing.Callable:
+        """
+        Return a version of `func` which times every call.
+        """
+        def timed(*args, **kwargs):
+            with self(stage):
+                return func(*args, **kwargs)
+        return timed
+
+    def report(self):
+        print(f"{'stage':<20}{'calls':>8}{'p50 ms':>10}{'p99 ms':>10}"
+              f"{'total s':>10}")
+        for stage, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            p50 = percentile(ordered, 0.50) * 1000
+            p99 = percentile(ordered, 0.99) * 1000
+            print(f"{stage:<20}{len(samples):>8}{p50:>10.2f}{p99:>10.2f}"
+                  f"{sum(samples):>10.2f}")
+
+
+def percentile(ordered: typing.List[float], q: float) -> float:
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+def make_signers(
+        directory: str,
+        count: int,
+        algorithm: str) -> typing.List[pkc.PrivateKey]:
+    """
+    Create `count` keypairs, and publish each public key in the key cache
+    as though GitHub had served it.
+    """
+    signers = []
+    for i in range(count):
+        path = os.path.join(directory, f"id_{i}")
+        subprocess.run([
+            'ssh-keygen', '-q', '-t', algorithm, '-f', path, '-N', ''
+        ], check=True)
+        profile = pkc.Profile(f"bench-signer-{i}")
+        with open(path + ".pub") as f:
+            pkc.KEY_CACHE.put(profile.username, f.read())
+        signers.append(pkc.PrivateKey(profile, pathlib.Path(path)))
+    return signers
+
+
+def make_traffic(
+        signers: typing.List[pkc.PrivateKey],
+        topics: int,
+        messages: int) -> typing.Tuple[
+            typing.List[pkc.SignedMessage], typing.Dict[str, str]]:
+    """
+    Sign `messages` chat messages, spread round-robin across signers and
+    topics. Each message names the previous message on its topic as its
+    parent, so every one of them should become the topic HEAD in turn.
+    Returns the messages and the HEAD we expect each topic to end at.
+    """
+    heads: typing.Dict[str, str] = {}
+    traffic = []
+    for i in range(messages):
+        topic = f"topic-{i % topics}"
+        signer = signers[i % len(signers)]
+        interior = pkc.InteriorMessage(
+            pkc.Topic(topic), heads.get(topic, ""), f"message {i}")
+        message = signer.sign_data(interior.dumps().encode())
+        heads[topic] = message.digest()
+        traffic.append(message)
+    return traffic, heads
+
+
+def run(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Signing {args.messages} messages "
+              f"from {args.signers} {args.algorithm} signers...")
+        signers = make_signers(directory, args.signers, args.algorithm)
+        traffic, heads = make_traffic(signers, args.topics, args.messages)
+
+    config = pkc.DaemonConfig(
+        "local", "bucket", "table", "queue", backend="local",
+        verify_workers=args.workers)
+    lock_table, s3, sqs = config.connect()
+    sqs.wait_seconds = 0
+    for message in traffic:
+        sqs.send(message.dumps())
+
+    # Time the backend calls and the pipeline stages individually, by
+    # wrapping the relevant methods on these particular instances.
+    watch = Stopwatch()
+    s3.read = watch.wrap("s3.read", s3.read)
+    s3.write = watch.wrap("s3.write", s3.write)
+    lock_table.acquire = watch.wrap("lock.acquire", lock_table.acquire)
+    lock_table.release = watch.wrap("lock.release", lock_table.release)
+    verifier = pkc.Verifier(config.verify_workers)
+    verifier.check_batch = watch.wrap("verify", verifier.check_batch)
+    lock = pkc.TopicLock(
+        lock_table, config.lease_seconds, config.lease_idle_seconds)
+    lock.start()
+    bucket = pkc.PublicChatBucket(s3, lock)
+    bucket.write_message = watch.wrap("write", bucket.write_message)
+    pipeline = pkc.DaemonPipeline(verifier, bucket, config.write_workers)
+    process = pipeline.process
+    outcomes: typing.Counter[pkc.Outcome] = collections.Counter()
+
+    def counted(messages, sent=None):
+        results = process(messages, sent)
+        outcomes.update(results)
+        return results
+    pipeline.process = counted
+
+    # This mirrors the loop in `daemon_main` (by way of Queue.batches),
+    # with each step timed.
+    print(f"Processing with batch size {config.batch_size}...")
+    queue = pkc.Queue(sqs)
+    start = time.perf_counter()
+    while len(sqs) > 0:
+        with watch("receive"):
+            batch = queue.receive_batch(config.batch_size)
+        with watch("process"):
+            pipeline.process_batch(batch)
+        with watch("ack"):
+            queue.finish(batch, delay=0)
+    elapsed = time.perf_counter() - start
+
+    print()
+    watch.report()
+    print()
+    for outcome, count in outcomes.items():
+        print(f"{outcome.name.lower()}: {count}")
+    for name, value in lock.stats.items():
+        print(f"lock {name}: {value:g}")
+    for topic, head in heads.items():
+        if s3.read(f"topics/{topic}") != head:
+            print(f"warning: {topic} did not end at the expected HEAD")
+    print(f"{args.messages / elapsed:.1f} messages/sec "
+          f"({elapsed:.2f}s for {args.messages} messages)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--signers', type=int, default=8)
+    parser.add_argument('--topics', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--workers', type=int,
+                        default=pkc.DEFAULT_VERIFY_WORKERS)
+    parser.add_argument('--algorithm', choices=['rsa', 'ed25519'],
+                        default='rsa')
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Copyright 2024 Robert D. French
+"""
+Message Handling Microbenchmark
+
+Follows a batch of chat messages through the steps that every message
+goes through, in the daemon or the chat client: load it from JSON,
+verify it, compute its digest, read its interior, and store it. For
+each step we report the time and the memory allocated per message, and
+finally how much memory a message takes up while we hold on to it.
+
+    python3 -m tests.bench_message --messages 1000
+"""
+import argparse
+import pathlib
+import tempfile
+import time
+import tracemalloc
+import typing
+from . import pkc
+from .bench_daemon import make_signers, make_traffic
+
+
+STAGES: typing.List[typing.Tuple[
+        str, typing.Callable[[pkc.SignedMessage], typing.Any]]] = [
+    ("verify", pkc.VERIFIER.verify),
+    ("digest", pkc.SignedMessage.digest),
+    ("digest again", pkc.SignedMessage.digest),
+    ("interior", pkc.SignedMessage.interior),
+    ("interior again", pkc.SignedMessage.interior),
+    ("dumps", pkc.SignedMessage.dumps),
+]
+
+
+def run_stages(
+        wire: typing.List[str],
+        store: pkc.MessageStore,
+        measure: typing.Callable[[str, typing.Callable[[], typing.Any]],
+                                 typing.Any]):
+    """
+    Load every message from `wire`, then take all of them through each
+    stage in turn, calling `measure` to run (and time, or trace) each
+    stage.
+    """
+    messages = measure(
+        "loads", lambda: [pkc.SignedMessage.loads(w) for w in wire])
+    for name, stage in STAGES:
+        measure(name, lambda: [stage(m) for m in messages])
+    measure("store", lambda: [store.put(m) for m in messages])
+
+
+def run(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Signing {args.messages} messages "
+              f"with {args.algorithm} keys...")
+        signers = make_signers(directory, args.signers, args.algorithm)
+        traffic, _ = make_traffic(signers, args.topics, args.messages)
+        wire = [m.dumps() for m in traffic]
+        count = len(wire)
+
+        # First, time each stage on its own...
+        seconds: typing.Dict[str, float] = {}
+
+        def timed(name, func):
+            start = time.perf_counter()
+            result = func()
+            seconds[name] = time.perf_counter() - start
+            return result
+        run_stages(wire, pkc.MessageStore(
+            pathlib.Path(directory) / "timed"), timed)
+
+        # ...and then go through it all again, on fresh copies of the
+        # messages, counting what each stage allocates. Tracing slows
+        # everything down, which is why we don't time this run.
+        allocated: typing.Dict[str, typing.Tuple[int, int]] = {}
+
+        def traced(name, func):
+            tracemalloc.start()
+            result = func()
+            allocated[name] = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return result
+        run_stages(wire, pkc.MessageStore(
+            pathlib.Path(directory) / "traced"), traced)
+
+    print(f"{'stage':<16}{'us/msg':>10}{'kept B/msg':>12}"
+          f"{'peak B/msg':>12}")
+    for name in seconds:
+        kept, peak = allocated[name]
+        print(f"{name:<16}{seconds[name] / count * 1e6:>10.1f}"
+              f"{kept / count:>12.0f}{peak / count:>12.0f}")
+
+    # Finally, how much does it cost to hold on to a message once all
+    # of its caches are filled in? This is what the chat client's
+    # history and the daemon's queues pay.
+    tracemalloc.start()
+    held = [pkc.SignedMessage.loads(w) for w in wire]
+    for message in held:
+        message.digest()
+        message.interior()
+    kept, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    body = sum(len(w) for w in wire) / count
+    print()
+    print(f"{kept / count:.0f} bytes per message held in memory "
+          f"({body:.0f} bytes of JSON on the wire)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--signers', type=int, default=4)
+    parser.add_argument('--topics', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--algorithm', choices=['rsa', 'ed25519'],
+                        default='rsa')
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
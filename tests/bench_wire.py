@@ -0,0 +1,95 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+#
+# Copyright 2024 Robert D. French
+"""
+Wire Format Microbenchmark
+
+Compares the JSON form of a batch of chat messages with the packed
+binary form (SignedMessage.pack), with and without compression: how
+long each takes to encode and decode per message, and how many bytes
+each message takes up on the wire or on disk.
+
+    python3 -m tests.bench_wire --messages 1000 --algorithm ed25519
+"""
+import argparse
+import json
+import tempfile
+import time
+import typing
+from . import pkc
+from .bench_daemon import make_signers, make_traffic
+
+
+FORMATS: typing.List[typing.Tuple[
+        str,
+        typing.Callable[[pkc.SignedMessage], bytes],
+        typing.Callable[[bytes], pkc.SignedMessage]]] = [
+    # Call json.dumps ourselves, rather than SignedMessage.dumps, which
+    # would only do the work once per message.
+    ("json",
+     lambda m: json.dumps(m.into_dict()).encode(),
+     lambda d: pkc.SignedMessage.loads(d.decode())),
+    ("packed",
+     lambda m: m.pack(compress=False),
+     pkc.SignedMessage.unpack),
+    ("packed+zlib",
+     lambda m: m.pack(),
+     pkc.SignedMessage.unpack),
+]
+
+
+def timed(func: typing.Callable[[], typing.Any]) -> typing.Tuple[
+        float, typing.Any]:
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def run(args: argparse.Namespace):
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"Signing {args.messages} messages "
+              f"with {args.algorithm} keys...")
+        signers = make_signers(directory, args.signers, args.algorithm)
+        traffic, _ = make_traffic(signers, args.topics, args.messages)
+    count = len(traffic)
+
+    print(f"{'format':<14}{'encode us':>10}{'decode us':>10}"
+          f"{'bytes/msg':>11}{'vs json':>9}")
+    json_size = None
+    for name, encode, decode in FORMATS:
+        encode_seconds, encoded = timed(lambda: [encode(m) for m in traffic])
+        # Decode into fresh messages, and make sure they are the same
+        # messages we started with (down to their ids).
+        decode_seconds, decoded = timed(lambda: [decode(d) for d in encoded])
+        for original, copy in zip(traffic, decoded):
+            if copy.digest() != original.digest():
+                print(f"warning: {name} changed message {original.digest()}")
+        size = sum(len(d) for d in encoded) / count
+        json_size = json_size or size
+        print(f"{name:<14}{encode_seconds / count * 1e6:>10.1f}"
+              f"{decode_seconds / count * 1e6:>10.1f}"
+              f"{size:>11.0f}{size / json_size:>9.2f}")
+
+    # Where do the JSON bytes go? The body and signature are base64,
+    # and the signature inside is armored base64 besides.
+    body = sum(len(m.body) for m in traffic) / count
+    raw = sum(len(m.signature.raw() or b"") for m in traffic) / count
+    print()
+    print(f"{body:.0f} bytes of body and {raw:.0f} bytes of signature "
+          f"per message, before any base64")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--signers', type=int, default=4)
+    parser.add_argument('--topics', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--algorithm', choices=['rsa', 'ed25519'],
+                        default='ed25519')
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
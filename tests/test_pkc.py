@@ -4,11 +4,23 @@
 #
 # Copyright 2024 Robert D. French
 import base64
+import collections
+import concurrent.futures
+import http.client
+import http.server
+import io
 import json
+import os
 import pathlib
 import pytest
+import sys
 import tempfile
+import threading
+import time
 import typing
+import zlib
+import urllib.error
+import dataclasses
 from dataclasses import dataclass
 from . import pkc
 
@@ -34,7 +46,16 @@ class FakeRestClient:
     def get(self, url: str) -> str:
         self.urls.append(url)
         self.payloads.append(None)
-        return self.responses.pop()
+        response = self.responses.pop()
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def get_bytes(self, url: str, headers=None) -> typing.Optional[bytes]:
+        response = self.get(url)
+        if isinstance(response, str):
+            return response.encode()
+        return response
 
     def post_json(self, url: str, payload: dict) -> str:
         self.urls.append(url)
@@ -62,6 +83,74 @@ def test_dumps_message():
     assert message.dumps() == text
 
 
+def test_message_memoizes():
+    """
+    Show that a message works out its digest and interior message only
+    once, and can't be changed afterwards (which would make them wrong),
+    but doesn't hold on to its JSON form.
+    """
+    message = chat_message("math", "hi")
+    assert message.digest() is message.digest()
+    assert message.dumps() is not message.dumps()
+    assert message.interior() is message.interior()
+    assert message.interior().text == "hi"
+    assert not hasattr(message, '__dict__')
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        message.body = b"changed"
+    copy = pkc.SignedMessage.loads(message.dumps())
+    assert copy == message
+    assert copy.digest() == message.digest()
+
+
+def test_message_pack():
+    """
+    Show that a message survives packing, with or without compression,
+    and keeps its id. This signature isn't a real one, so it is packed
+    just as it appears in JSON.
+    """
+    message = chat_message("math", "hello " * 50)
+    packed = message.pack()
+    assert packed[len(pkc.PACKED_MAGIC)] == pkc.PACKED_ZLIB
+    assert len(packed) < len(message.dumps()) // 2
+    for data in [packed, message.pack(compress=False)]:
+        copy = pkc.SignedMessage.unpack(data)
+        assert copy == message
+        assert copy.digest() == message.digest()
+        assert pkc.SignedMessage.from_wire(data) == message
+    tiny = pkc.SignedMessage(pkc.Profile("a"), b"", pkc.Signature(""))
+    assert tiny.pack()[len(pkc.PACKED_MAGIC)] == 0
+    assert pkc.SignedMessage.from_wire(message.dumps().encode()) == message
+
+
+@pytest.mark.parametrize("data", [
+    b"{}",
+    pkc.PACKED_MAGIC,
+    pkc.PACKED_MAGIC + b"\x80",
+    pkc.PACKED_MAGIC + b"\x00\x00\x00\x00\x05ab",
+    pkc.PACKED_MAGIC + b"\x00" + b"\x00" * 12 + b"extra",
+    pkc.PACKED_MAGIC + b"\x01not zlib",
+    pkc.PACKED_MAGIC + b"\x01" + zlib.compress(
+        b"\x00" * (pkc.MAX_MESSAGE_SIZE + 1)),
+])
+def test_message_unpack_rejects(data):
+    """
+    Show that anything which isn't a whole packed message, or which
+    would inflate to more than any message could be, is refused.
+    """
+    with pytest.raises(ValueError):
+        pkc.SignedMessage.unpack(data)
+
+
+def test_queue_reads_packed_messages():
+    """
+    Show that the daemon's queue reader accepts packed messages, which
+    are queued in base64, as well as JSON ones.
+    """
+    message = chat_message("math", "hello")
+    packed = base64.b64encode(message.pack()).decode()
+    assert pkc.Queue.parse(packed) == message
+    assert pkc.Queue.parse(message.dumps()) == message
+
 def test_get_head():
     """
     Get the HEAD of a topic from the chat service
@@ -147,19 +236,471 @@ def test_post_message():
                 'signature': 'c'
             }
 
+def test_get_backlog():
+    """
+    Show that a backlog is fetched newest first (by following each
+    message's parent), but handed back oldest first.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    rest_client = FakeRestClient([third.dumps(), second.dumps()])
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    backlog = client.get_backlog(third.digest(), first.digest())
+    assert [m.interior().text for m in backlog] == ["second", "third"]
+    assert rest_client.urls == [
+        f"{pkc.API_BASE_URL}/messages/{third.digest()}",
+        f"{pkc.API_BASE_URL}/messages/{second.digest()}"]
+
+
+def test_get_backlog_limit():
+    """
+    Show that we give up on a backlog after `limit` messages.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    rest_client = FakeRestClient([second.dumps()])
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    backlog = client.get_backlog(second.digest(), "", limit=1)
+    assert [m.interior().text for m in backlog] == ["second"]
+
+
+def test_get_backlog_missing_message():
+    rest_client = FakeRestClient([None])
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    with pytest.raises(Exception, match="unavailable"):
+        list(client.get_backlog("aaa", ""))
+
+
+def test_get_backlog_forged_message():
+    """
+    Show that a forged message stops the backlog, but only once every
+    message older than it has been handed back.
+    """
+    first = chat_message("math", "first")
+    forged = chat_message("math", "forged", parent=first.digest(),
+                          signature="bad")
+    rest_client = FakeRestClient([forged.dumps(), first.dumps()])
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    backlog = client.get_backlog(forged.digest(), "")
+    assert next(backlog).interior().text == "first"
+    with pytest.raises(Exception, match=forged.digest()):
+        next(backlog)
+
+
+def test_get_backlog_from_history():
+    """
+    Show that once we are more than one message behind, the rest of
+    the backlog comes from the topic's history, and that any gaps in
+    the history (which look just like the end of a segment) are fetched
+    directly if there is no segment there.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    fourth = chat_message("math", "fourth", parent=third.digest())
+    history = "\n".join([first.dumps(), third.dumps()])
+    rest_client = FakeRestClient(
+        [fourth.dumps(), history, None, second.dumps()])
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    backlog = client.get_backlog(fourth.digest(), "", topic="math")
+    assert [m.interior().text for m in backlog] == [
+        "first", "second", "third", "fourth"]
+    assert rest_client.urls == [
+        f"{pkc.API_BASE_URL}/messages/{fourth.digest()}",
+        f"{pkc.API_BASE_URL}/history/math",
+        f"{pkc.API_BASE_URL}/history/{second.digest()}",
+        f"{pkc.API_BASE_URL}/messages/{second.digest()}"]
+
+
+class RecordingUI:
+    def __init__(self):
+        self.lines = []
+
+    def chatbuffer_add(self, msg, topic=None):
+        self.lines.append(msg)
+
+
+def test_subscription_keeps_its_place():
+    """
+    Show that when a bad message stops an update, the messages before it
+    stay shown, and the next update picks up after them rather than
+    showing them again.
+    """
+    first = chat_message("math", "first")
+    forged = chat_message("math", "forged", parent=first.digest(),
+                          signature="bad")
+    second = chat_message("math", "second", parent=first.digest())
+    history = "\n".join([first.dumps(), forged.dumps()])
+    rest_client = FakeRestClient([forged.dumps(), history, second.dumps()])
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    ui = RecordingUI()
+    topic = pkc.Topic("math")
+    subscription = pkc.TopicSubscription(
+        topic, ui, pkc.ChatPointer(topic), client)
+    with pytest.raises(Exception, match=forged.digest()):
+        subscription.update(forged.digest())
+    assert subscription.ptr.parent == first.digest()
+    assert subscription.update(second.digest())
+    assert ui.lines == ["a: first", "a: second"]
+    assert subscription.ptr.parent == second.digest()
+
+
+def test_get_history():
+    """
+    Show that the last few messages on a topic, or those since a given
+    message, are fetched in one request.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    history = "\n".join([first.dumps(), "garbled", second.dumps(),
+                         third.dumps()])
+    rest_client = FakeRestClient([history] * 3)
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    assert client.get_history("math") == [first, second, third]
+    assert client.get_history("math", since=first.digest()) == [
+        second, third]
+    assert client.get_history("math", limit=1) == [third]
+    assert rest_client.urls == [f"{pkc.API_BASE_URL}/history/math"] * 3
+
+
+def test_get_history_stores_messages(tmp_path):
+    first = chat_message("math", "first")
+    store = pkc.MessageStore(tmp_path)
+    rest_client = FakeRestClient([first.dumps()])
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, rest_client, FakeVerifier(), store)
+    assert client.get_history("math") == [first]
+    assert store.get(first.digest()) == first
+
+
+def test_get_history_forged_message():
+    first = chat_message("math", "first")
+    forged = chat_message("math", "forged", parent=first.digest(),
+                          signature="bad")
+    history = "\n".join([first.dumps(), forged.dumps()])
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, FakeRestClient([history]), FakeVerifier())
+    with pytest.raises(Exception, match=forged.digest()):
+        client.get_history("math")
+
+
+def test_get_history_unavailable():
+    """
+    Show that a topic without history (for example, on a backend
+    which predates it) has no history, rather than an error.
+    """
+    error = urllib.error.HTTPError("url", 404, "Not Found", {}, None)
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, FakeRestClient([error, None]), FakeVerifier())
+    assert client.get_history("math") == []
+    assert client.get_history("math") == []
+
+
+def test_get_history_ends():
+    """
+    Show that the history stops where the backend's does, when there is
+    no older segment to be had.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    history = "\n".join([second.dumps(), third.dumps()])
+    rest_client = FakeRestClient([history, None])
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, rest_client, FakeVerifier())
+    assert client.get_history("math") == [second, third]
+    assert rest_client.urls[-1] == \
+        f"{pkc.API_BASE_URL}/history/{first.digest()}"
+
+
+def test_get_history_errors():
+    """
+    Show that a backend which fails to answer is an error, unlike one
+    which has no history to give.
+    """
+    error = urllib.error.HTTPError("url", 503, "Unavailable", {}, None)
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, FakeRestClient([error]), FakeVerifier())
+    with pytest.raises(urllib.error.HTTPError):
+        client.get_history("math")
+
+
+def test_get_backlog_from_store(tmp_path):
+    """
+    Show that stored messages are neither downloaded nor verified
+    again, and that newly verified messages are stored.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    store = pkc.MessageStore(tmp_path)
+    store.put(second)
+    store.put(first)
+    rest_client = FakeRestClient([third.dumps()])
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, rest_client, FakeVerifier(), store)
+    backlog = client.get_backlog(third.digest(), "")
+    assert [m.interior().text for m in backlog] == [
+        "first", "second", "third"]
+    assert len(rest_client.urls) == 1
+    assert store.get(third.digest()) == third
+
+
+def test_get_message_from_store(tmp_path):
+    message = chat_message("math", "first")
+    store = pkc.MessageStore(tmp_path)
+    store.put(message)
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, FakeRestClient([]), store=store)
+    assert client.get_message(message.digest()) == message
+
+
+def test_get_message_stores_valid_message(tmp_path):
+    message = chat_message("math", "first")
+    store = pkc.MessageStore(tmp_path)
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, FakeRestClient([message.dumps()]), FakeVerifier(),
+        store)
+    assert client.get_message(message.digest()) == message
+    assert store.get(message.digest()) == message
+
+
+def test_message_store_get(tmp_path):
+    """
+    Show that only intact messages are served from the store, and
+    never anything that isn't named by a digest.
+    """
+    message = chat_message("math", "first")
+    store = pkc.MessageStore(tmp_path)
+    assert store.get(message.digest()) is None
+    store.put(message)
+    store.put(message)
+    assert store.get(message.digest()) == message
+    assert store.get("../topics/math") is None
+    damaged = chat_message("math", "second")
+    (tmp_path / "messages" / damaged.digest()).write_text(message.dumps())
+    assert store.get(damaged.digest()) is None
+    assert store.stats() == {'hits': 1, 'misses': 3}
+
+
+def test_message_store_get_evicted(tmp_path, monkeypatch):
+    """
+    Show that a message evicted (by another thread) just after we read
+    it is still handed back.
+    """
+    message = chat_message("math", "first")
+    store = pkc.MessageStore(tmp_path)
+    store.put(message)
+    load = store._load
+
+    def evicting_load(message_id):
+        loaded = load(message_id)
+        (tmp_path / "messages" / message_id).unlink()
+        return loaded
+    monkeypatch.setattr(store, "_load", evicting_load)
+    assert store.get(message.digest()) == message
+
+
+def test_message_store_reads_json(tmp_path):
+    """
+    Show that messages are stored packed, and that messages which older
+    versions stored as JSON can still be read.
+    """
+    packed = chat_message("math", "packed")
+    old = chat_message("math", "old")
+    store = pkc.MessageStore(tmp_path)
+    store.put(packed)
+    path = tmp_path / "messages" / packed.digest()
+    assert path.read_bytes().startswith(pkc.PACKED_MAGIC)
+    (tmp_path / "messages" / old.digest()).write_text(old.dumps())
+    assert store.get(old.digest()) == old
+    assert store.get(packed.digest()) == packed
+
+
+def test_message_store_heads(tmp_path):
+    store = pkc.MessageStore(tmp_path)
+    topic = pkc.Topic("math/algebra")
+    assert store.head(topic) == ""
+    store.set_head(topic, "abc")
+    assert store.head(topic) == "abc"
+    assert store.head(pkc.Topic("math")) == ""
+
+
+def test_message_store_history(tmp_path):
+    """
+    Show that history is read oldest first, stopping at the first
+    message the store doesn't have.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    store = pkc.MessageStore(tmp_path)
+    store.put(second)
+    store.put(third)
+    history = store.history(third.digest())
+    assert [m.interior().text for m in history] == ["second", "third"]
+    assert len(store.history(third.digest(), limit=1)) == 1
+    assert store.history("") == []
+
+
+def test_message_store_eviction(tmp_path):
+    """
+    Show that the least recently read messages are evicted once the
+    store grows past its size limit.
+    """
+    messages = [chat_message("math", str(i)) for i in range(4)]
+    size = len(messages[0].pack())
+    store = pkc.MessageStore(tmp_path, max_bytes=3 * size)
+    for i, message in enumerate(messages[:3]):
+        store.put(message)
+        os.utime(tmp_path / "messages" / message.digest(), (i, i))
+    store.get(messages[0].digest())
+    # A new store picks up the size of whatever is already on disk.
+    store = pkc.MessageStore(tmp_path, max_bytes=3 * size)
+    store.put(messages[3])
+    assert store.get(messages[0].digest()) == messages[0]
+    assert store.get(messages[1].digest()) is None
+    assert store.get(messages[2].digest()) is None
+    assert store.get(messages[3].digest()) == messages[3]
+
+
+def test_message_store_compact(tmp_path):
+    """
+    Show that compaction keeps only the recent history of the topics
+    we have visited, and then enforces the size limit.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    stray = chat_message("art", "stray")
+    store = pkc.MessageStore(tmp_path)
+    assert store.compact() == {'kept': 0, 'removed': 0, 'bytes': 0}
+    for message in [first, second, stray]:
+        store.put(message)
+    store.set_head(pkc.Topic("math"), second.digest())
+    (tmp_path / "messages" / "junk.tmp").write_text("junk")
+    assert store.compact(limit=2) == {
+        'kept': 2, 'removed': 2,
+        'bytes': len(first.pack()) + len(second.pack())}
+    assert store.get(stray.digest()) is None
+
+    store.max_bytes = len(second.pack())
+    os.utime(tmp_path / "messages" / first.digest(), (0, 0))
+    assert store.compact()['kept'] == 1
+    assert store.history(second.digest()) == [second]
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.ports.append(self.client_address[1])
+        if self.path == "/missing":
+            self.send_error(404)
+            return
+        self.respond(f"{self.path}\n".encode())
+        # Hang up without saying so, as a server dropping an idle
+        # connection might.
+        if self.path == "/drop":
+            self.close_connection = True
+
+    def do_POST(self):
+        self.server.ports.append(self.client_address[1])
+        length = int(self.headers['Content-Length'])
+        self.respond(self.rfile.read(length))
+
+    def respond(self, data: bytes):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), KeepAliveHandler)
+    server.ports = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_rest_client_keep_alive(http_server):
+    """
+    Show that consecutive requests share one connection.
+    """
+    base = f"http://127.0.0.1:{http_server.server_port}"
+    client = pkc.RestClient()
+    assert client.get(f"{base}/messages/a") == "/messages/a"
+    assert client.get(f"{base}/topics/b?x=1") == "/topics/b?x=1"
+    assert client.post_json(f"{base}/messages", {"a": 1}) == '{"a": 1}'
+    assert len(set(http_server.ports)) == 1
+
+
+def test_rest_client_reconnect(http_server):
+    """
+    Show that a connection closed by the server is replaced.
+    """
+    base = f"http://127.0.0.1:{http_server.server_port}"
+    client = pkc.RestClient()
+    assert client.get(f"{base}/drop") == "/drop"
+    assert client.get(f"{base}/again") == "/again"
+    assert len(set(http_server.ports)) == 2
+
+
+def test_rest_client_does_not_repost(http_server):
+    """
+    Show that a POST is not sent again when a kept-alive connection turns
+    out to be closed, since the server may already have acted on it.
+    """
+    base = f"http://127.0.0.1:{http_server.server_port}"
+    client = pkc.RestClient()
+    assert client.get(f"{base}/drop") == "/drop"
+    with pytest.raises((http.client.HTTPException, ConnectionError)):
+        client.post_json(f"{base}/messages", {"a": 1})
+    assert client.post_json(f"{base}/messages", {"a": 1}) == '{"a": 1}'
+    assert len(http_server.ports) == 2
+
+
+def test_rest_client_unreachable(http_server):
+    base = f"http://127.0.0.1:{http_server.server_port}"
+    http_server.shutdown()
+    http_server.server_close()
+    with pytest.raises(ConnectionError):
+        pkc.RestClient().get(f"{base}/a")
+
+
+def test_rest_client_error(http_server):
+    base = f"http://127.0.0.1:{http_server.server_port}"
+    with pytest.raises(urllib.error.HTTPError) as e:
+        pkc.RestClient().request("GET", f"{base}/missing")
+    assert e.value.code == 404
+    assert pkc.RestClient().get(f"{base}/missing") is None
+
+
 class MockSQSWrapper:
     def __init__(self, messages: typing.List[dict]):
         self.messages = list(messages)
         self.messages.reverse()
 
-    def receive(self, _max_messages: int):
+    def receive(self, max_messages: int):
         if len(self.messages) == 0:
             raise Exception("End of test")
-        return [self.messages.pop()]
+        count = min(max_messages, len(self.messages))
+        return [self.messages.pop() for _ in range(count)]
 
     def delete(self, _receipt_handle: str):
         pass
 
+    def delete_batch(self, receipt_handles: typing.List[str]):
+        self.deleted = receipt_handles
+
 def test_queue_iterate():
     msg_json_1 = '{"profile": "a", "body": "Yg==", "signature": "c"}'
     msg_json_2 = '{"profile": "d", "body": "ZQ==", "signature": "f"}'
@@ -192,15 +733,21 @@ class MockS3Wrapper:
 class MockLock:
     def __init__(self):
         self.table = dict()
+        self.tokens = 0
 
     def acquire(self, topic, ttl):
         if topic in self.table:
-            return False
-        self.table[topic] = ttl
-        return True
+            return 0
+        self.tokens += 1
+        self.table[topic] = self.tokens
+        return self.tokens
+
+    def renew(self, topic, token, ttl):
+        return self.table.get(topic) == token
 
-    def release(self, topic):
-        del self.table[topic]
+    def release(self, topic, token):
+        if self.table.get(topic) == token:
+            del self.table[topic]
 
 def test_bucket_write_message():
     interior = {"topic": "math", "text": "I love math", "parent": ""}
@@ -272,6 +819,65 @@ def test_chat_config():
         config = pkc.ChatConfig.load(f.name)
         assert config.username == "a"
         assert str(config.key_path) == "b"
+        assert config.api_base_url == pkc.API_BASE_URL
+        assert config.longpoll_url is None
+        assert config.history_size == pkc.DEFAULT_CHAT_HISTORY
+
+
+def test_chat_config_display():
+    config = pkc.ChatConfig("a", pathlib.Path("b"), history_size=50)
+    with tempfile.NamedTemporaryFile() as f:
+        config.dump(f.name)
+        assert pkc.ChatConfig.load(f.name) == config
+
+
+def test_chat_history_wraps():
+    """
+    Show that messages are wrapped to the width of the window, and that
+    only the bottom of the history is returned.
+    """
+    history = pkc.ChatHistory()
+    history.add("abcdefg")
+    history.add("")
+    history.add("hij")
+    assert history.lines(3, 10) == ["abc", "def", "g", "hij"]
+    assert history.lines(3, 2) == ["g", "hij"]
+    assert history.lines(10, 10) == ["abcdefg", "hij"]
+    assert history.lines(0, 2) == ["i", "j"]
+
+
+def test_chat_history_caches_wrapping():
+    """
+    Show that a message is only rewrapped when the width changes, and
+    only if it is near enough the bottom to be seen.
+    """
+    history = pkc.ChatHistory()
+    for i in range(100):
+        history.add(f"message {i}")
+    history.lines(5, 4)
+    assert [e[1] for e in history.entries][-3:] == [0, 5, 5]
+    assert history.entries[-2][2] == ["messa", "ge 98"]
+    assert history.entries[0][1] == 0
+    wrapped = history.entries[-1][2]
+    history.lines(5, 4)
+    assert history.entries[-1][2] is wrapped
+
+
+def test_chat_history_is_bounded():
+    history = pkc.ChatHistory(max_messages=3)
+    for i in range(10):
+        history.add(str(i))
+    assert len(history) == 3
+    assert history.lines(80, 10) == ["7", "8", "9"]
+    assert history.version == 10
+
+
+def test_chat_config_server():
+    config = pkc.ChatConfig("a", pathlib.Path("b"), "http://localhost:8080",
+                            "http://localhost:8081")
+    with tempfile.NamedTemporaryFile() as f:
+        config.dump(f.name)
+        assert pkc.ChatConfig.load(f.name) == config
 
 def test_daemon_config():
     config = pkc.DaemonConfig.load("tests/test_chat.ini")
@@ -279,7 +885,1309 @@ def test_daemon_config():
     assert config.bucket_name == "b"
     assert config.table_name == "c"
     assert config.queue_name == "d"
+    assert config.key_cache_ttl == pkc.DEFAULT_KEY_CACHE_TTL
+    assert config.key_cache_path is None
+    assert config.batch_size == 10
+    assert config.http_port is None
+    assert not config.json_logs
+    assert config.digest_cache_size == pkc.DEFAULT_DIGEST_CACHE_SIZE
+    assert not config.digest_cache_shared
+    assert config.profile_rate == pkc.DEFAULT_PROFILE_RATE
+    assert config.topic_burst == pkc.DEFAULT_TOPIC_BURST
 
 def test_topic():
     t = pkc.Topic("number-theory")
     assert str(t) == "number-theory"
+
+
+def test_queue_batches():
+    messages = [
+            {'Body': '{"profile": "a", "body": "Yg==", "signature": "c"}',
+             'ReceiptHandle': 'a'},
+            {'Body': 'not a wmap message', 'ReceiptHandle': 'b'},
+            {'Body': '{"profile": "d", "body": "ZQ==", "signature": "f"}',
+             'ReceiptHandle': 'c'},
+        ]
+    sqs = MockSQSWrapper(messages)
+    queue = pkc.Queue(sqs)
+    batches = queue.batches(10)
+    batch = next(batches)
+    assert [m.body for m in batch.messages] == [b'b', b'e']
+    with pytest.raises(Exception):
+        next(batches)
+    assert sqs.deleted == ['a', 'c', 'b']
+
+
+class FakeVerifier:
+    """
+    Messages are valid if their signature is "good", and can't be checked
+    at all (as if GitHub were down) if it is "unreachable".
+    """
+    def check_batch(self, messages):
+        return [
+            None if m.signature.content == "unreachable" else self.verify(m)
+            for m in messages
+        ]
+
+    def verify(self, message):
+        return message.signature.content == "good"
+
+    def submit(self, message):
+        future = concurrent.futures.Future()
+        future.set_result(self.verify(message))
+        return future
+
+
+def chat_message(topic, text, parent="", signature="good"):
+    interior = {"topic": topic, "text": text, "parent": parent}
+    body = base64.b64encode(json.dumps(interior).encode()).decode()
+    return pkc.SignedMessage.from_dict(
+        {"profile": "a", "body": body, "signature": signature})
+
+
+def test_pipeline_process():
+    """
+    Show that a batch is verified as a whole, that only valid messages
+    are written, and that each topic's messages are applied in order.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    forged = chat_message("math", "forged", signature="bad")
+    other = chat_message("art", "hello")
+    plain = pkc.SignedMessage.from_dict(
+        {"profile": "a", "body": "Yg==", "signature": "good"})
+    s3 = MockS3Wrapper(dict())
+    bucket = pkc.PublicChatBucket(s3, pkc.TopicLock(MockLock()))
+    pipeline = pkc.DaemonPipeline(FakeVerifier(), bucket)
+    outcomes = pipeline.process([first, forged, other, second, plain])
+    assert outcomes == [
+        pkc.Outcome.VALID,
+        pkc.Outcome.INVALID,
+        pkc.Outcome.VALID,
+        pkc.Outcome.VALID,
+        pkc.Outcome.ERROR]
+    assert s3.contents['topics/math'] == second.digest()
+    assert s3.contents['topics/art'] == other.digest()
+    assert f"messages/{forged.digest()}" not in s3.contents
+
+
+def test_local_lock():
+    """
+    Show that the local lock behaves like a conditional put: it can't be
+    acquired while held, but can be once released or expired.
+    """
+    lock = pkc.LocalLock()
+    assert lock.acquire("math", 60) == 1
+    assert not lock.acquire("math", 60)
+    lock.release("math", 1)
+    assert lock.acquire("math", -1) == 2
+    assert lock.acquire("math", 60) == 3
+    assert not lock.renew("math", 2, 60)
+    assert lock.renew("math", 3, 60)
+    lock.release("math", 2)
+    assert not lock.acquire("math", 60)
+
+
+def test_local_lock_values():
+    """
+    Show that the first value remembered under a key sticks until it
+    expires.
+    """
+    lock = pkc.LocalLock()
+    assert lock.recall("a") is None
+    assert lock.remember("a", "x", 60)
+    assert not lock.remember("a", "y", 60)
+    assert lock.recall("a") == "x"
+    assert lock.remember("b", "x", -1)
+    assert lock.recall("b") is None
+    assert lock.remember("b", "y", 60)
+
+
+def test_local_s3_memory():
+    s3 = pkc.LocalS3()
+    s3.write("topics/math", "x")
+    assert s3.read("topics/math") == "x"
+    assert s3.read("topics/art") is None
+
+
+def test_local_s3_files():
+    with tempfile.TemporaryDirectory() as d:
+        s3 = pkc.LocalS3(pathlib.Path(d))
+        s3.write("topics/math", "x")
+        assert pkc.LocalS3(pathlib.Path(d)).read("topics/math") == "x"
+        assert s3.read("topics/art") is None
+
+
+def test_local_s3_stays_inside_root(tmp_path):
+    """
+    Show that no key, however it is spelled, can lead outside the root.
+    """
+    root = tmp_path / "bucket"
+    root.mkdir()
+    os.symlink(tmp_path, root / "link")
+    s3 = pkc.LocalS3(root)
+    for key in ["topics/../../x", "../x", "/x", "topics//x", "link/x"]:
+        with pytest.raises(ValueError, match="outside"):
+            s3.write(key, "x")
+        with pytest.raises(ValueError, match="outside"):
+            s3.read(key)
+    assert os.listdir(tmp_path) == ["bucket"]
+
+
+def test_local_sqs_visibility():
+    """
+    Show that a received message is hidden until its visibility timeout
+    expires, and is then delivered again with a new receipt handle which
+    replaces the old one.
+    """
+    sqs = pkc.LocalSQS(visibility_timeout=0.05, wait_seconds=0)
+    sqs.send("hello")
+    first = sqs.receive(10)
+    assert [m['Body'] for m in first] == ["hello"]
+    assert sqs.receive(10) == []
+    sqs.wait_seconds = 1
+    second = sqs.receive(10)
+    assert second[0]['Attributes']['ApproximateReceiveCount'] == "2"
+    with pytest.raises(Exception):
+        sqs.delete(first[0]['ReceiptHandle'])
+    with pytest.raises(Exception):
+        sqs.requeue(first[0]['ReceiptHandle'])
+    sqs.delete_batch([first[0]['ReceiptHandle']])
+    sqs.delete_batch([second[0]['ReceiptHandle']])
+    assert len(sqs) == 0
+
+
+def test_local_backend():
+    """
+    Show that the daemon can run entirely against the local backend.
+    """
+    config = pkc.DaemonConfig("a", "b", "c", "d", backend="local")
+    lock_table, s3, sqs = config.connect()
+    sqs.wait_seconds = 0
+    bucket = pkc.PublicChatBucket(s3, pkc.TopicLock(lock_table))
+    pipeline = pkc.DaemonPipeline(FakeVerifier(), bucket)
+    message = chat_message("math", "hello")
+    sqs.send(message.dumps())
+    batch = next(pkc.Queue(sqs).batches())
+    assert pipeline.process(batch.messages) == [pkc.Outcome.VALID]
+    assert s3.read("topics/math") == message.digest()
+
+
+class CountingS3Wrapper(MockS3Wrapper):
+    def __init__(self, contents):
+        super().__init__(contents)
+        self.reads = collections.Counter()
+        self.writes = collections.Counter()
+
+    def read(self, key):
+        self.reads[key] += 1
+        return super().read(key)
+
+    def write(self, key, value):
+        self.writes[key] += 1
+        return super().write(key, value)
+
+
+def test_bucket_caches_head():
+    """
+    Show that while we hold a topic's lease, the topic HEAD is only read
+    from S3 once, and that a new lease means reading it again.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    s3 = CountingS3Wrapper(dict())
+    lock = pkc.TopicLock(MockLock(), ttl=60)
+    bucket = pkc.PublicChatBucket(s3, lock)
+    assert bucket.write_message(first)
+    assert bucket.write_message(second)
+    assert not bucket.write_message(first)
+    assert s3.reads['topics/math'] == 1
+    lock.release_all()
+    assert bucket.write_message(third)
+    assert s3.reads['topics/math'] == 2
+    assert s3.contents['topics/math'] == third.digest()
+
+
+def test_bucket_history():
+    """
+    Show that each new HEAD is appended to the topic's history, that a
+    full segment of history is sealed under the id of its newest message
+    (and never written again), and that (like HEAD) the history is only
+    read from S3 once per lease.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    third = chat_message("math", "third", parent=second.digest())
+    stale = chat_message("math", "stale", parent=first.digest())
+    s3 = CountingS3Wrapper(dict())
+    lock = pkc.TopicLock(MockLock(), ttl=60)
+    bucket = pkc.PublicChatBucket(s3, lock, segment_size=2)
+    assert bucket.write_message(first)
+    assert bucket.write_message(second)
+    assert s3.contents['history/math'] == "\n".join(
+        [first.dumps(), second.dumps()])
+    lock.release_all()
+    assert not bucket.write_message(stale)
+    assert bucket.write_message(third)
+    assert s3.contents['history/math'] == third.dumps()
+    assert s3.contents[f'history/{second.digest()}'] == "\n".join(
+        [first.dumps(), second.dumps()])
+    assert s3.writes[f'history/{second.digest()}'] == 1
+    assert s3.reads['history/math'] == 2
+
+
+def test_bucket_serializes_once(monkeypatch):
+    """
+    Show that a message is turned into JSON once when it is stored,
+    although the JSON is written twice: as the message and as its line
+    of history.
+    """
+    message = chat_message("math", "first")
+    message.digest()
+    calls = []
+    dumps = pkc.SignedMessage.dumps
+
+    def counting_dumps(self):
+        calls.append(self)
+        return dumps(self)
+    monkeypatch.setattr(pkc.SignedMessage, "dumps", counting_dumps)
+    s3 = MockS3Wrapper(dict())
+    bucket = pkc.PublicChatBucket(s3, pkc.TopicLock(MockLock()))
+    assert bucket.write_message(message)
+    assert calls == [message]
+    assert s3.contents['history/math'] == \
+        s3.contents[f'messages/{message.digest()}']
+
+
+def test_topic_lock_reuses_lease():
+    """
+    Show that the lock table is only consulted when we don't already
+    hold a live lease, and that a failure inside the lock releases it.
+    """
+    table = MockLock()
+    lock = pkc.TopicLock(table, ttl=60)
+    with lock(pkc.Topic("math")) as first:
+        pass
+    with lock(pkc.Topic("math")) as second:
+        pass
+    assert first.generation == second.generation
+    with pytest.raises(ValueError):
+        with lock(pkc.Topic("math")):
+            raise ValueError()
+    assert "math" not in table.table
+    short = pkc.TopicLock(pkc.LocalLock(), ttl=0)
+    with short(pkc.Topic("math")) as first:
+        pass
+    with short(pkc.Topic("math")) as second:
+        pass
+    assert first.generation != second.generation
+
+
+def test_pipeline_requeues_on_contention():
+    """
+    Show that when another worker holds a topic's lock, that topic's
+    messages are handed back to the queue instead of being lost, while
+    other topics carry on.
+    """
+    table = MockLock()
+    table.table['math'] = 1
+    lock = pkc.TopicLock(table, retries=1, retry_delay=0)
+    bucket = pkc.PublicChatBucket(MockS3Wrapper(dict()), lock)
+    pipeline = pkc.DaemonPipeline(FakeVerifier(), bucket)
+    sqs = pkc.LocalSQS(wait_seconds=0)
+    queue = pkc.Queue(sqs)
+    for message in [chat_message("math", "a"), chat_message("art", "b"),
+                    chat_message("math", "c")]:
+        sqs.send(message.dumps())
+    batch = queue.receive_batch()
+    pipeline.process_batch(batch)
+    assert batch.retry == [0, 2]
+    queue.finish(batch, delay=0)
+    assert len(sqs) == 2
+    assert [m['Body'] for m in sqs.receive(10)] == [
+        chat_message("math", "a").dumps(), chat_message("math", "c").dumps()]
+
+
+def test_metrics_render():
+    """
+    Show that counters and histograms come out in Prometheus' text
+    format, with cumulative buckets.
+    """
+    metrics = pkc.Metrics(buckets=[0.1, 1.0])
+    metrics.count('pkc_messages_total', outcome='valid')
+    metrics.count('pkc_messages_total', 2, outcome='valid')
+    metrics.observe('pkc_stage_seconds', 0.1, stage='verify')
+    metrics.observe('pkc_stage_seconds', 0.5, stage='verify')
+    metrics.observe('pkc_stage_seconds', 5, stage='verify')
+    metrics.observe('pkc_queue_to_head_seconds', 0.05)
+    metrics.gauge('pkc_key_cache', lambda: {'hits': 4})
+    lines = metrics.render().splitlines()
+    assert "# TYPE pkc_messages_total counter" in lines
+    assert 'pkc_messages_total{outcome="valid"} 3' in lines
+    assert 'pkc_stage_seconds_bucket{stage="verify",le="0.1"} 1' in lines
+    assert 'pkc_stage_seconds_bucket{stage="verify",le="1"} 2' in lines
+    assert 'pkc_stage_seconds_bucket{stage="verify",le="+Inf"} 3' in lines
+    assert 'pkc_stage_seconds_sum{stage="verify"} 5.6' in lines
+    assert 'pkc_stage_seconds_count{stage="verify"} 3' in lines
+    assert 'pkc_queue_to_head_seconds_bucket{le="0.1"} 1' in lines
+    assert 'pkc_queue_to_head_seconds_count 1' in lines
+    assert 'pkc_key_cache_hits 4' in lines
+    metrics.clear()
+    assert 'pkc_queue_to_head_seconds_count 1' not in metrics.render()
+
+
+def test_metrics_logs(capsys):
+    """
+    Show that errors are reported in the usual way, unless we've been
+    asked for JSON logs, in which case every event is reported.
+    """
+    metrics = pkc.Metrics()
+    metrics.error('write', Exception("oops"))
+    metrics.log('batch', messages=1)
+    assert capsys.readouterr().out == "Error: oops\n"
+    metrics.json_logs = True
+    metrics.error('write', Exception("oops"))
+    metrics.log('batch', messages=1)
+    records = [json.loads(line)
+               for line in capsys.readouterr().out.splitlines()]
+    assert [r['event'] for r in records] == ['error', 'batch']
+    assert records[0]['stage'] == 'write'
+    assert records[1]['messages'] == 1
+    assert 'pkc_errors_total{stage="write"} 2' in metrics.render()
+
+
+def test_pipeline_metrics():
+    """
+    Show that the pipeline counts each message's outcome, times each
+    stage, and measures how long messages took to go from the queue to
+    HEAD.
+    """
+    pkc.METRICS.clear()
+    first = chat_message("math", "first")
+    stale = chat_message("math", "stale")
+    forged = chat_message("math", "forged", signature="bad")
+    bucket = pkc.PublicChatBucket(
+        MockS3Wrapper(dict()), pkc.TopicLock(MockLock()))
+    pipeline = pkc.DaemonPipeline(FakeVerifier(), bucket)
+    sqs = pkc.LocalSQS(wait_seconds=0)
+    queue = pkc.Queue(sqs)
+    for message in [first, stale, forged]:
+        sqs.send(message.dumps())
+    batch = queue.receive_batch()
+    assert all(0 < sent <= time.time() for sent in batch.sent)
+    pipeline.process_batch(batch)
+    queue.finish(batch)
+    lines = pkc.METRICS.render().splitlines()
+    assert 'pkc_messages_total{outcome="valid"} 1' in lines
+    assert 'pkc_messages_total{outcome="parent_mismatch"} 1' in lines
+    assert 'pkc_messages_total{outcome="invalid"} 1' in lines
+    assert 'pkc_queue_to_head_seconds_count 1' in lines
+    for stage in ['receive', 'verify', 'write', 's3_read', 's3_write',
+                  'lock_acquire', 'ack']:
+        assert f'pkc_stage_seconds_count{{stage="{stage}"}}' in "\n".join(
+            lines)
+
+
+def test_pipeline_counts_lock_failures():
+    pkc.METRICS.clear()
+    table = MockLock()
+    table.table['math'] = 1
+    lock = pkc.TopicLock(table, retries=1, retry_delay=0)
+    bucket = pkc.PublicChatBucket(MockS3Wrapper(dict()), lock)
+    pipeline = pkc.DaemonPipeline(FakeVerifier(), bucket)
+    pipeline.process([chat_message("math", "a"), chat_message("math", "b")])
+    lines = pkc.METRICS.render().splitlines()
+    assert 'pkc_messages_total{outcome="lock_failed"} 2' in lines
+    assert 'pkc_errors_total{stage="lock"} 1' in lines
+
+
+def test_digest_cache():
+    """
+    Show that only final outcomes are remembered, and that the least
+    recently used are forgotten first.
+    """
+    cache = pkc.DigestCache(max_entries=2)
+    cache.put("a", pkc.Outcome.VALID)
+    cache.put("b", pkc.Outcome.INVALID)
+    cache.put("c", pkc.Outcome.REQUEUED)
+    cache.put("d", pkc.Outcome.ERROR)
+    assert cache.get("a") == pkc.Outcome.VALID
+    cache.put("e", pkc.Outcome.VALID)
+    assert cache.get("b") is None
+    assert cache.get("c") is None
+    assert cache.get("a") == pkc.Outcome.VALID
+    assert cache.stats() == {'entries': 2, 'hits': 2, 'misses': 2}
+
+
+def test_digest_cache_shared():
+    """
+    Show that daemons sharing a lock table learn from each other.
+    """
+    table = pkc.LocalLock()
+    table.acquire("math", 60)
+    first = pkc.DigestCache(table=table)
+    second = pkc.DigestCache(table=table)
+    first.put("a", pkc.Outcome.INVALID)
+    assert second.get("a") == pkc.Outcome.INVALID
+    assert second.entries["a"] == pkc.Outcome.INVALID
+    assert second.get("math") is None
+
+
+class CountingVerifier(FakeVerifier):
+    def __init__(self):
+        self.verified = []
+
+    def check_batch(self, messages):
+        self.verified.extend(messages)
+        return super().check_batch(messages)
+
+
+def test_pipeline_skips_duplicates():
+    """
+    Show that a message seen before, in this batch or an earlier one,
+    gets the same outcome without being verified or written again.
+    """
+    pkc.METRICS.clear()
+    first = chat_message("math", "first")
+    forged = chat_message("math", "forged", signature="bad")
+    s3 = CountingS3Wrapper(dict())
+    verifier = CountingVerifier()
+    bucket = pkc.PublicChatBucket(s3, pkc.TopicLock(MockLock()))
+    pipeline = pkc.DaemonPipeline(
+        verifier, bucket, digests=pkc.DigestCache())
+    assert pipeline.process([first, forged, first]) == [
+        pkc.Outcome.VALID, pkc.Outcome.INVALID, pkc.Outcome.VALID]
+    assert pipeline.process([forged, first]) == [
+        pkc.Outcome.INVALID, pkc.Outcome.VALID]
+    assert verifier.verified == [first, forged]
+    assert s3.writes[f"messages/{first.digest()}"] == 1
+    assert 'pkc_messages_total{outcome="duplicate"} 3' in \
+        pkc.METRICS.render()
+
+
+def test_pipeline_requeues_unverified():
+    """
+    Show that a message we couldn't check (say, because GitHub was down)
+    is requeued rather than remembered as invalid, so that a retry of it
+    gets verified again.
+    """
+    pkc.METRICS.clear()
+    stuck = chat_message("math", "stuck", signature="unreachable")
+    verifier = CountingVerifier()
+    s3 = MockS3Wrapper(dict())
+    bucket = pkc.PublicChatBucket(s3, pkc.TopicLock(MockLock()))
+    pipeline = pkc.DaemonPipeline(
+        verifier, bucket, digests=pkc.DigestCache())
+    assert pipeline.process([stuck]) == [pkc.Outcome.REQUEUED]
+    assert pipeline.process([stuck]) == [pkc.Outcome.REQUEUED]
+    assert verifier.verified == [stuck, stuck]
+    assert f"messages/{stuck.digest()}" not in s3.contents
+    assert 'pkc_messages_total{outcome="unverified"} 2' in \
+        pkc.METRICS.render()
+
+
+def test_rate_limiter():
+    """
+    Show that each name gets its own burst, then a steady trickle.
+    """
+    limiter = pkc.RateLimiter(rate=1, burst=2, max_entries=2)
+    assert limiter.allow("a", now=0)
+    assert limiter.allow("a", now=0)
+    assert not limiter.allow("a", now=0.5)
+    assert limiter.allow("a", now=1.5)
+    assert not limiter.allow("a", now=1.5)
+    assert limiter.allow("b", now=1.5)
+    limiter.allow("c", now=1.5)
+    assert list(limiter.buckets) == ["b", "c"]
+
+
+def admissible_message(topic, text, parent="", profile="a"):
+    """
+    A chat message which looks right in every way, except that its
+    signature is nonsense.
+    """
+    key = pkc.SSHBuffer.pack_string(b"ssh-ed25519") + \
+        pkc.SSHBuffer.pack_string(b"k" * 32)
+    armored = pkc.SSHSignature(
+        key, pkc.NAMESPACE, b"", "sha512", b"s" * 64).armor()
+    interior = {"topic": topic, "text": text, "parent": parent}
+    body = base64.b64encode(json.dumps(interior).encode()).decode()
+    signature = base64.b64encode(armored.encode()).decode()
+    return pkc.SignedMessage.from_dict(
+        {"profile": profile, "body": body, "signature": signature})
+
+
+def admission(profile_burst=10, topic_burst=10):
+    return pkc.Admission(
+        pkc.RateLimiter(0, profile_burst), pkc.RateLimiter(0, topic_burst))
+
+
+def test_admission_accepts():
+    assert admission().screen(admissible_message("math", "hi")) is None
+
+
+@pytest.mark.parametrize("changes,reason", [
+    ({"body": b"x" * pkc.MAX_MESSAGE_SIZE}, 'size'),
+    ({"body": b"not json"}, 'schema'),
+    ({"body": b'{"topic": "math", "text": "hi"}'}, 'schema'),
+    ({"body": b'{"topic": 7, "parent": "", "text": "hi"}'}, 'schema'),
+    ({"body": b'{"topic": "", "parent": "", "text": "hi"}'}, 'schema'),
+    ({"body": b'{"topic": "../../x", "parent": "", "text": "hi"}'}, 'schema'),
+    ({"body": b'{"topic": "a//b", "parent": "", "text": "hi"}'}, 'schema'),
+    ({"body": b'{"topic": "a", "parent": "abc", "text": "hi"}'}, 'schema'),
+    ({"profile": pkc.Profile("-a")}, 'schema'),
+    ({"profile": pkc.Profile("a--b")}, 'schema'),
+    ({"signature": pkc.Signature("good")}, 'schema'),
+])
+def test_admission_rejects_junk(changes, reason):
+    message = dataclasses.replace(admissible_message("math", "hi"), **changes)
+    assert admission().screen(message) == reason
+
+
+@pytest.mark.parametrize("key_type,namespace,hash_algorithm", [
+    (b"ecdsa-sha2-nistp256", pkc.NAMESPACE, "sha512"),
+    (b"ssh-ed25519", "file", "sha512"),
+    (b"ssh-ed25519", pkc.NAMESPACE, "sha1"),
+])
+def test_admission_rejects_signatures(key_type, namespace, hash_algorithm):
+    sig = pkc.SSHSignature(
+        pkc.SSHBuffer.pack_string(key_type), namespace, b"",
+        hash_algorithm, b"")
+    signature = pkc.Signature(base64.b64encode(sig.armor().encode()).decode())
+    message = dataclasses.replace(
+        admissible_message("math", "hi"), signature=signature)
+    assert admission().screen(message) == 'schema'
+
+
+@pytest.fixture
+def key_cache(monkeypatch):
+    """
+    Give a test its own empty key cache in place of the shared one.
+    """
+    cache = pkc.KeyCache()
+    monkeypatch.setattr(pkc, "KEY_CACHE", cache)
+    yield cache
+
+
+def test_admission_limits(key_cache):
+    """
+    Show that users without keys are turned away, and that users and
+    topics are held to their rate limits.
+    """
+    key_cache.mark_missing("nobody")
+    gate = admission(profile_burst=1, topic_burst=2)
+    assert gate.screen(admissible_message("a", "1", profile="nobody")) == \
+        'no_keys'
+    assert gate.check([
+        admissible_message("a", "1", profile="x"),
+        admissible_message("a", "2", profile="x"),
+        admissible_message("a", "3", profile="y")]) == [
+            None, None, pkc.Outcome.REQUEUED]
+    assert gate.charge(admissible_message("a", "1", profile="x"))
+    assert not gate.charge(admissible_message("a", "2", profile="x"))
+
+
+def test_admission_keeps_topics_in_order():
+    """
+    Show that once a message is sent back to the queue, so is every later
+    message for its topic, whatever its parent; other topics carry on.
+    """
+    pkc.METRICS.clear()
+    gate = admission(topic_burst=1)
+    first = admissible_message("math", "first")
+    sibling = admissible_message("math", "sibling")
+    other = admissible_message("art", "other")
+    assert gate.check([first, sibling, other]) == [
+        None, pkc.Outcome.REQUEUED, None]
+    gate = admission(topic_burst=0)
+    later = admissible_message("math", "later", parent="a" * 64)
+    assert gate.check([first, sibling, later]) == [pkc.Outcome.REQUEUED] * 3
+    assert 'pkc_rejected_total{reason="held"} 2' in pkc.METRICS.render()
+
+
+def test_admission_stale_parents():
+    """
+    Show that while we hold a topic's lease, messages which don't
+    follow its HEAD (or an earlier message in the same batch) are
+    turned away, and that we don't guess once the lease is gone.
+    """
+    pkc.METRICS.clear()
+    first = admissible_message("math", "first")
+    lock = pkc.TopicLock(MockLock(), ttl=60)
+    bucket = pkc.PublicChatBucket(MockS3Wrapper(dict()), lock)
+    bucket.write_message(first)
+    assert bucket.known_head("math") == first.digest()
+    second = admissible_message("math", "second", parent=first.digest())
+    third = admissible_message("math", "third", parent=second.digest())
+    stale = admissible_message("math", "stale")
+    other = admissible_message("art", "other", parent="a" * 64)
+    assert admission().check([second, stale, third, other], bucket) == [
+        None, pkc.Outcome.REJECTED, None, None]
+    assert 'pkc_rejected_total{reason="stale"} 1' in pkc.METRICS.render()
+    lock.release("math")
+    assert bucket.known_head("math") is None
+    assert admission().check([stale], bucket) == [None]
+
+
+class AcceptingVerifier(CountingVerifier):
+    def check_batch(self, messages):
+        self.verified.extend(messages)
+        return [True] * len(messages)
+
+
+def test_pipeline_admission(key_cache):
+    """
+    Show that messages turned away by admission never reach the
+    verifier, and that those whose authors are over their rate limit go
+    back to the queue, along with every later message for their topic.
+    """
+    verifier = AcceptingVerifier()
+    bucket = pkc.PublicChatBucket(
+        MockS3Wrapper(dict()), pkc.TopicLock(MockLock()))
+    pipeline = pkc.DaemonPipeline(
+        verifier, bucket, admission=admission(profile_burst=1))
+    first = admissible_message("math", "first")
+    junk = chat_message("math", "junk")
+    again = admissible_message("math", "again", parent=first.digest())
+    other = admissible_message(
+        "math", "other", parent=again.digest(), profile="b")
+    assert pipeline.process([first, junk, again, other]) == [
+        pkc.Outcome.VALID, pkc.Outcome.REJECTED, pkc.Outcome.REQUEUED,
+        pkc.Outcome.REQUEUED]
+    assert verifier.verified == [first, again, other]
+
+
+class ForgeryVerifier(FakeVerifier):
+    """
+    Takes admissible messages at their word: they are forged if their
+    text says so.
+    """
+    def check_batch(self, messages):
+        return [
+            not m.interior().text.startswith("forged") for m in messages
+        ]
+
+
+def test_pipeline_charges_verified_authors(key_cache):
+    """
+    Show that forgeries in someone's name don't use up their rate limit,
+    since it is only charged once a message has been verified.
+    """
+    bucket = pkc.PublicChatBucket(
+        MockS3Wrapper(dict()), pkc.TopicLock(MockLock()))
+    pipeline = pkc.DaemonPipeline(
+        ForgeryVerifier(), bucket, admission=admission(profile_burst=1))
+    forged = [admissible_message("math", f"forged {i}") for i in range(3)]
+    genuine = admissible_message("math", "genuine")
+    assert pipeline.process(forged + [genuine]) == [
+        pkc.Outcome.INVALID] * 3 + [pkc.Outcome.VALID]
+
+
+def test_topic_ring():
+    """
+    Show that topics are spread over every shard, always land on the same
+    shard, and mostly stay put when a shard is added.
+    """
+    topics = [f"topic-{i}" for i in range(1000)]
+    four = pkc.TopicRing(4)
+    five = pkc.TopicRing(5)
+    assert {four.shard(t) for t in topics} == {0, 1, 2, 3}
+    assert all(four.shard(t) == four.shard(t) for t in topics)
+    moved = sum(four.shard(t) != five.shard(t) for t in topics)
+    assert moved < 400
+
+
+def test_topic_lock_renews_busy_leases():
+    """
+    Show that a lease in use is renewed before it expires, and that an
+    idle one is released so that other workers can have the topic.
+    """
+    table = pkc.LocalLock()
+    lock = pkc.TopicLock(table, ttl=60, idle=60)
+    with lock(pkc.Topic("math")) as lease:
+        lease.expires_at -= 50
+        lock.maintain()
+    assert lease.live(30)
+    assert lock.stats['renewals'] == 1
+    lock.idle = 0
+    lock.maintain()
+    assert lock.stats['releases'] == 1
+    assert table.acquire("math", 60)
+
+
+class ReacquiredLeases(dict):
+    """
+    Leases which are let go of and taken again (say, after a failed
+    write) just after TopicLock.maintain has taken its list of them.
+    """
+    def __init__(self, leases, table):
+        super().__init__(leases)
+        self.table = table
+
+    def values(self):
+        leases = list(super().values())
+        for old in leases:
+            self.table.release(old.topic, old.token)
+            token = self.table.acquire(old.topic, 60)
+            self[old.topic] = dataclasses.replace(old, token=token, users=1)
+        return leases
+
+
+def test_topic_lock_keeps_leases_picked_up():
+    """
+    Show that `maintain` only releases the idle lease it looked at, and
+    not a newer one for the same topic which is in use.
+    """
+    table = pkc.LocalLock()
+    lock = pkc.TopicLock(table, ttl=60, idle=0)
+    with lock(pkc.Topic("math")):
+        pass
+    lock.leases = ReacquiredLeases(lock.leases, table)
+    lock.maintain()
+    assert lock.stats['releases'] == 0
+    assert lock.leases["math"].users == 1
+    assert not table.acquire("math", 60)
+
+
+def test_topic_lock_fences_lost_leases():
+    """
+    Show that once another worker takes over a lock (say, because ours
+    expired while we weren't looking), our renewal fails and our stale
+    lease can no longer move the topic HEAD.
+    """
+    table = pkc.LocalLock()
+    lock = pkc.TopicLock(table, ttl=60, idle=60)
+    bucket = pkc.PublicChatBucket(MockS3Wrapper(dict()), lock)
+    pipeline = pkc.DaemonPipeline(FakeVerifier(), bucket)
+    assert bucket.write_message(chat_message("math", "a"))
+    lease = lock.leases["math"]
+    table.table["math"] = (0, lease.token)
+    assert table.acquire("math", 60)
+    lease.expires_at -= 50
+    lock.maintain()
+    assert lock.stats['lease_losses'] == 1
+    with pytest.raises(pkc.LeaseLost):
+        lock.check(lease)
+    assert pipeline.process([chat_message("math", "b")]) == [
+        pkc.Outcome.REQUEUED]
+
+
+def test_topic_lock_background_release():
+    """
+    Show that the background thread lets go of idle leases on its own.
+    """
+    lock = pkc.TopicLock(pkc.LocalLock(), ttl=60, idle=0.01)
+    with lock(pkc.Topic("math")):
+        pass
+    lock.start()
+    for _ in range(100):
+        if lock.stats['releases']:
+            break
+        time.sleep(0.01)
+    assert "math" not in lock.leases
+
+
+def test_topic_watch():
+    """
+    Show that waiting on a topic ends as soon as that topic (and only
+    that topic) changes.
+    """
+    watch = pkc.TopicWatch()
+    version = watch.version("math")
+    assert watch.wait("math", version, 0.01) is None
+    threading.Timer(0.05, watch.publish, ["art", "a"]).start()
+    threading.Timer(0.1, watch.publish, ["math", "b"]).start()
+    assert watch.wait("math", version, 5) == "b"
+    assert watch.version("math") == version + 1
+    assert watch.wait("math", version, 5) == "b"
+
+
+def test_topic_watch_any():
+    """
+    Show that waiting on several topics ends as soon as any of them
+    changes, reporting just the ones which did.
+    """
+    watch = pkc.TopicWatch()
+    versions = {"math": watch.version("math"), "art": watch.version("art")}
+    assert watch.wait_any(versions, 0.01) == {}
+    threading.Timer(0.05, watch.publish, ["music", "a"]).start()
+    threading.Timer(0.1, watch.publish, ["art", "b"]).start()
+    assert watch.wait_any(versions, 5) == {"art": "b"}
+
+
+@pytest.fixture
+def chat_server():
+    s3 = pkc.LocalS3()
+    watch = pkc.TopicWatch()
+    bucket = pkc.PublicChatBucket(
+        s3, pkc.TopicLock(MockLock()), watch=watch)
+    server = pkc.ChatServer(
+        ("127.0.0.1", 0), bucket, watch, pkc.LocalSQS(wait_seconds=0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def server_client(server):
+    url = f"http://127.0.0.1:{server.server_port}"
+    return pkc.ChatAPIClient(
+        url, pkc.RestClient(), FakeVerifier(), longpoll_url=url)
+
+
+def test_chat_server_history_segments(chat_server):
+    """
+    Show that a client reads a topic's history a segment at a time,
+    following each segment back to the one before it.
+    """
+    chat_server.bucket.segment_size = 2
+    chain = [chat_message("math", "0")]
+    for i in range(1, 5):
+        chain.append(chat_message("math", f"{i}", parent=chain[-1].digest()))
+    for message in chain:
+        chat_server.bucket.write_message(message)
+    client = server_client(chat_server)
+    assert client.get_history("math") == chain
+    assert client.get_history("math", since=chain[1].digest()) == chain[2:]
+    urls = []
+    get = client.rest_client.get
+
+    def counted(url):
+        urls.append(url)
+        return get(url)
+    client.rest_client.get = counted
+    backlog = client.get_backlog(chain[-1].digest(), "", topic="math")
+    assert list(backlog) == chain
+    assert [url.split("/", 3)[3] for url in urls] == [
+        "history/math",
+        f"history/{chain[3].digest()}",
+        f"history/{chain[1].digest()}"]
+
+
+def test_chat_server_reads(chat_server):
+    """
+    Show that the server answers the same requests as the API Gateway.
+    """
+    first = chat_message("math/algebra", "first")
+    second = chat_message("math/algebra", "second", parent=first.digest())
+    chat_server.bucket.write_message(first)
+    chat_server.bucket.write_message(second)
+    client = server_client(chat_server)
+    assert client.get_head("math/algebra") == second.digest()
+    assert client.get_message(first.digest()) == first
+    assert client.get_history("math/algebra") == [first, second]
+    assert client.get_head("art") == ""
+    client.post_message(first)
+    assert chat_server.queue.receive(1)[0]['Body'] == first.dumps()
+
+
+@pytest.mark.parametrize("method,path,status", [
+    ("GET", "/secrets/a", 404),
+    ("GET", "/topics/..%2F..%2Fetc", 404),
+    ("POST", "/topics/math", 404),
+])
+def test_chat_server_errors(chat_server, method, path, status):
+    rest_client = pkc.RestClient()
+    url = f"http://127.0.0.1:{chat_server.server_port}{path}"
+    with pytest.raises(urllib.error.HTTPError) as e:
+        rest_client.request(method, url, b"")
+    assert e.value.code == status
+
+
+def test_chat_server_bad_wait(chat_server):
+    url = f"http://127.0.0.1:{chat_server.server_port}/topics/a?wait=soon"
+    with pytest.raises(urllib.error.HTTPError):
+        pkc.RestClient().get(url)
+
+
+def test_chat_server_post_limits(chat_server):
+    rest_client = pkc.RestClient()
+    url = f"http://127.0.0.1:{chat_server.server_port}/messages"
+    with pytest.raises(urllib.error.HTTPError) as e:
+        rest_client.request("POST", url, b"x" * (pkc.MAX_MESSAGE_SIZE + 1))
+    assert e.value.code == 413
+    chat_server.queue = None
+    with pytest.raises(urllib.error.HTTPError) as e:
+        rest_client.request("POST", url, b"")
+    assert e.value.code == 404
+
+
+@pytest.mark.parametrize("length,body,status", [
+    ("lots", b"", 400),
+    ("-1", b"", 400),
+    (None, b"", 411),
+    ("2", b"\xff\xfe", 400),
+])
+def test_chat_server_bad_posts(chat_server, length, body, status):
+    """
+    Show that a post with a missing or nonsensical length, or a body
+    which isn't text, is answered with an error rather than dropped.
+    """
+    connection = http.client.HTTPConnection(
+        "127.0.0.1", chat_server.server_port, timeout=5)
+    connection.putrequest("POST", "/messages")
+    if length is not None:
+        connection.putheader("Content-Length", length)
+    connection.endheaders(body)
+    assert connection.getresponse().status == status
+    connection.close()
+    assert chat_server.queue.receive(1) == []
+
+
+def test_chat_server_metrics(chat_server):
+    pkc.METRICS.clear()
+    chat_server.bucket.write_message(chat_message("math", "first"))
+    url = f"http://127.0.0.1:{chat_server.server_port}/metrics"
+    text = pkc.RestClient().get(url)
+    assert "# TYPE pkc_stage_seconds histogram" in text
+    assert 'pkc_stage_seconds_count{stage="s3_write"} 3' in text
+
+
+def test_chat_server_long_poll(chat_server):
+    """
+    Show that a long poll is answered as soon as the topic moves on,
+    rather than when the wait runs out.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("math", "second", parent=first.digest())
+    chat_server.bucket.write_message(first)
+    client = server_client(chat_server)
+    assert client.wait_head("math", "") == first.digest()
+    threading.Timer(
+        0.1, chat_server.bucket.write_message, [second]).start()
+    start = time.monotonic()
+    assert client.wait_head("math", first.digest(), 10) == second.digest()
+    assert time.monotonic() - start < 5
+
+
+def test_chat_server_long_poll_timeout(chat_server):
+    """
+    Show that a long poll which runs out of time takes one last look
+    at HEAD, in case another daemon moved it.
+    """
+    first = chat_message("math", "first")
+    chat_server.bucket.write_message(first)
+    client = server_client(chat_server)
+    assert client.wait_head("math", first.digest(), 0.05) == first.digest()
+    chat_server.max_wait = 0.05
+    threading.Timer(
+        0.01, chat_server.bucket.s3.write, ["topics/math", "a" * 64]).start()
+    assert client.wait_head("math", first.digest()) == "a" * 64
+
+
+def test_wait_head_needs_server():
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, FakeRestClient([]))
+    with pytest.raises(Exception, match="long-poll"):
+        client.wait_head("math", "")
+
+
+def test_archive_records(tmp_path, monkeypatch):
+    """
+    Show that an archive yields every line of a .jsonl file and every
+    other file whole, walking directories in order (files before subdirectories).
+    """
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "one.json").write_bytes(b'{"a": 1}\n')
+    (tmp_path / "a.jsonl").write_bytes(b'{"x": 1}\n\n{"x": 2}\r\n')
+    single = tmp_path / "single.jsonl"
+    single.write_bytes(b'{"y": 1}')
+    archive = pkc.Archive([str(tmp_path), str(single)])
+    assert list(archive.records()) == [
+        (f"{tmp_path}/a.jsonl:1", b'{"x": 1}'),
+        (f"{tmp_path}/a.jsonl:3", b'{"x": 2}'),
+        (f"{tmp_path}/single.jsonl:1", b'{"y": 1}'),
+        (f"{tmp_path}/b/one.json", b'{"a": 1}\n'),
+        (f"{single}:1", b'{"y": 1}'),
+    ]
+    batches = list(archive.batches(2))
+    assert [len(b) for b in batches] == [2, 2, 1]
+    monkeypatch.setattr(
+        sys, "stdin", io.TextIOWrapper(io.BytesIO(b'{"z": 1}\n')))
+    assert list(pkc.Archive(["-"]).records()) == [("-:1", b'{"z": 1}')]
+
+
+def test_streaming_pool_bounds_backlog():
+    """
+    Show that a StreamingPool returns every result, and never reads
+    more than `jobs * backlog` items ahead of the ones it has finished.
+    """
+    pool = pkc.StreamingPool(jobs=2, backlog=3)
+    read = []
+    done = []
+
+    def items():
+        for i in range(50):
+            assert len(read) - len(done) <= 6
+            read.append(i)
+            yield i
+
+    def work(i):
+        time.sleep(0.001)
+        done.append(i)
+        return i * i
+
+    assert sorted(pool.map(work, items())) == [i * i for i in range(50)]
+    assert sorted(pool.map(sum, [(1, 2), (3, 4)])) == [3, 7]
+
+
+def test_streaming_pool_streams():
+    """
+    Show that a result is handed back as soon as it is ready, even while
+    the next item is slow in coming, and that results can be kept in
+    the order of the items.
+    """
+    pool = pkc.StreamingPool(jobs=4)
+    first_out = threading.Event()
+
+    def slow_items():
+        yield 1
+        assert first_out.wait(5)
+        yield 2
+    results = pool.map(lambda i: i, slow_items())
+    assert next(results) == 1
+    first_out.set()
+    assert list(results) == [2]
+
+    def work(i):
+        time.sleep(i / 100)
+        return i
+    assert list(pool.map(work, [3, 2, 1, 0], ordered=True)) == [3, 2, 1, 0]
+
+
+def test_streaming_pool_errors():
+    """
+    Show that an error in the work, or in reading the items, comes out of
+    the pool.
+    """
+    pool = pkc.StreamingPool(jobs=2)
+    with pytest.raises(ZeroDivisionError):
+        list(pool.map(lambda i: 1 / i, [1, 0, 2]))
+
+    def broken_items():
+        yield 1
+        raise OSError("unreadable")
+    with pytest.raises(OSError, match="unreadable"):
+        list(pool.map(lambda i: i, broken_items()))
+
+
+def test_chat_server_long_poll_many(chat_server):
+    """
+    Show that one request can wait on several topics at once, and is
+    answered with every topic's HEAD as soon as any of them moves.
+    """
+    first = chat_message("math", "first")
+    second = chat_message("art", "second")
+    chat_server.bucket.write_message(first)
+    client = server_client(chat_server)
+    since = {"math": "", "art": ""}
+    assert client.wait_heads(since) == {"math": first.digest(), "art": ""}
+    since["math"] = first.digest()
+    threading.Timer(
+        0.1, chat_server.bucket.write_message, [second]).start()
+    assert client.wait_heads(since, 10) == {
+        "math": first.digest(), "art": second.digest()}
+    since["art"] = second.digest()
+    chat_server.max_wait = 0.05
+    threading.Timer(
+        0.01, chat_server.bucket.s3.write, ["topics/math", "a" * 64]).start()
+    assert client.wait_heads(since)["math"] == "a" * 64
+
+
+@pytest.mark.parametrize("query", [
+    "topic=math",
+    "topic=..&since=",
+    "topic=math&since=&wait=soon",
+    "&".join(["topic=math&since="] * (pkc.MAX_LONGPOLL_TOPICS + 1)),
+])
+def test_chat_server_bad_heads(chat_server, query):
+    url = f"http://127.0.0.1:{chat_server.server_port}/heads?{query}"
+    with pytest.raises(urllib.error.HTTPError) as e:
+        pkc.RestClient().get(url)
+    assert e.value.code == 400
+
+
+def test_wait_heads_needs_server():
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, FakeRestClient([]))
+    with pytest.raises(Exception, match="long-poll"):
+        client.wait_heads({"math": ""})
+
+
+@dataclass
+class FakeSubscription:
+    """
+    Stands in for a TopicSubscription: each `update` reports the next of
+    `changes`, or raises it if it is an exception.
+    """
+    topic: pkc.Topic
+    changes: typing.List[typing.Any]
+    ptr: pkc.ChatPointer = None
+    ui: typing.Any = None
+
+    def __post_init__(self):
+        self.ptr = pkc.ChatPointer(self.topic, "parent")
+        self.ui = self
+        self.notices = []
+
+    def update(self, head=None):
+        change = self.changes.pop(0)
+        if isinstance(change, Exception):
+            raise change
+        return change
+
+    def chatbuffer_add(self, msg, topic=None):
+        self.notices.append((topic, msg))
+
+
+def test_poll_scheduler_backoff():
+    """
+    Show that each topic is polled on its own schedule: sooner after
+    news, later and later while it stays quiet, and soon again after
+    we post to it.
+    """
+    scheduler = pkc.PollScheduler(FakeRestClient([]), 2, max_exponent=3)
+    busy = FakeSubscription(pkc.Topic("busy"), [True, True])
+    quiet = FakeSubscription(pkc.Topic("quiet"), [False] * 4)
+    scheduler.subscribe(busy, now=0)
+    scheduler.subscribe(quiet, now=0)
+    assert scheduler.delay(now=0) == 0
+    assert scheduler.due(now=0) == ["busy", "quiet"]
+    assert scheduler.delay() is None
+    assert scheduler.poll("busy") and not scheduler.poll("quiet")
+    scheduler.record("busy", True, now=0)
+    scheduler.record("quiet", False, now=0)
+    assert scheduler.exponents == {"busy": 1, "quiet": 2}
+    assert scheduler.delay(now=0) == 2
+    assert scheduler.due(now=2) == ["busy"]
+    assert scheduler.due(now=4) == ["quiet"]
+    for now in [4, 12]:
+        scheduler.record("quiet", False, now=now)
+    assert scheduler.exponents["quiet"] == 3
+    scheduler.reset("quiet", now=13)
+    assert scheduler.delay(now=13) == 2
+    scheduler.reset("quiet", now=14)
+    assert scheduler.due(now=15) == ["quiet"]
+    assert scheduler.since() == {"busy": "parent", "quiet": "parent"}
+
+
+def test_poll_scheduler_schedule_stays_small():
+    """
+    Show that rescheduling a topic over and over, as happens while we
+    long poll and nothing takes polls off the schedule, doesn't grow
+    the schedule without bound.
+    """
+    scheduler = pkc.PollScheduler(FakeRestClient([]), 2)
+    for topic in ["math", "art"]:
+        scheduler.subscribe(FakeSubscription(pkc.Topic(topic), []), now=0)
+    for now in range(1000):
+        scheduler.record("math", now % 2 == 0, now=now)
+        scheduler.reset("art", now=now)
+    assert len(scheduler.heap) <= 4
+    assert scheduler.due(now=10 ** 6) == ["art", "math"]
+    scheduler.subscribe(FakeSubscription(pkc.Topic("math"), []), now=0)
+    scheduler.record("math", False, now=0)
+    assert scheduler.delay(now=0) == 2
+
+
+def test_poll_scheduler_wait():
+    """
+    Show that waiting for the schedule wakes up when a poll comes due,
+    including one scheduled while we wait.
+    """
+    scheduler = pkc.PollScheduler(FakeRestClient([]))
+    scheduler.subscribe(FakeSubscription(pkc.Topic("math"), []))
+    assert scheduler.wait() == ["math"]
+    threading.Timer(
+        0.05, scheduler.subscribe,
+        [FakeSubscription(pkc.Topic("art"), [])]).start()
+    assert scheduler.wait() == ["art"]
+    threading.Timer(0.05, scheduler.stop).start()
+    assert scheduler.wait() == []
+
+
+def test_poll_scheduler_reports_errors():
+    """
+    Show that a topic which can't be brought up to date doesn't stop
+    the scheduler; the error is shown in that topic's window instead.
+    """
+    scheduler = pkc.PollScheduler(FakeRestClient([]))
+    broken = FakeSubscription(pkc.Topic("math"), [Exception("oops")])
+    scheduler.subscribe(broken)
+    assert not scheduler.poll("math")
+    assert broken.notices == [("math", "[pubkey.chat]: oops")]
+
+
+def test_poll_scheduler_long_poll_errors():
+    """
+    Show that a long poll which can't be answered, or is answered with
+    something other than topic heads, sends us back to the schedule
+    rather than stopping the scheduler; and that the nonsense is
+    reported, once.
+    """
+    rest_client = FakeRestClient([
+        ConnectionRefusedError(),
+        "<html>Bad Gateway</html>",
+        "<html>Bad Gateway</html>",
+        "[]",
+        json.dumps({"math": "a" * 64, "art": 7}),
+    ])
+    client = pkc.ChatAPIClient(
+        pkc.API_BASE_URL, rest_client, longpoll_url="http://localhost")
+    scheduler = pkc.PollScheduler(client)
+    math = FakeSubscription(pkc.Topic("math"), [True])
+    art = FakeSubscription(pkc.Topic("art"), [False])
+    scheduler.subscribe(math)
+    scheduler.subscribe(art)
+    for _ in range(4):
+        assert not scheduler.longpoll()
+    assert [notice for _, notice in math.notices] == [
+        "[pubkey.chat]: long poll failed: Expecting value: "
+        "line 1 column 1 (char 0)",
+        "[pubkey.chat]: long poll failed: Not a map of topic heads: '[]'",
+    ]
+    assert scheduler.longpoll()
+    assert scheduler.longpoll_error is None
+    assert math.changes == [] and art.changes == []
+    client = pkc.ChatAPIClient(pkc.API_BASE_URL, FakeRestClient([]))
+    assert not pkc.PollScheduler(client).longpoll()
+    for i in range(pkc.MAX_LONGPOLL_TOPICS):
+        scheduler.subscribe(FakeSubscription(pkc.Topic(f"{i}"), []))
+    assert not scheduler.longpoll()
+
+
+def test_chat_server_packed(chat_server):
+    """
+    Show that the server hands out packed messages to clients which ask
+    for them, and JSON to everyone else; and that it takes packed
+    messages from clients, queueing them for the daemon.
+    """
+    message = chat_message("math", "first")
+    chat_server.bucket.write_message(message)
+    url = f"http://127.0.0.1:{chat_server.server_port}"
+    rest_client = pkc.RestClient()
+    path = f"{url}/messages/{message.digest()}"
+    assert rest_client.get(path) == message.dumps()
+    packed = rest_client.get_bytes(
+        path, {'Accept': pkc.PACKED_CONTENT_TYPE})
+    assert packed == message.pack()
+    assert server_client(chat_server).fetch_message(
+        message.digest()) == message
+
+    headers = {'Content-Type': pkc.PACKED_CONTENT_TYPE}
+    rest_client.request("POST", f"{url}/messages", packed, headers)
+    queued = chat_server.queue.receive(1)[0]['Body']
+    assert pkc.Queue.parse(queued) == message
+    with pytest.raises(urllib.error.HTTPError) as e:
+        rest_client.request("POST", f"{url}/messages", b"{}", headers)
+    assert e.value.code == 400
+
+
+def test_chat_server_serves_odd_messages(chat_server):
+    """
+    Show that a stored object which can't be packed is served as it is.
+    """
+    chat_server.bucket.s3.write("messages/odd", "not a message")
+    url = f"http://127.0.0.1:{chat_server.server_port}/messages/odd"
+    assert pkc.RestClient().get_bytes(
+        url, {'Accept': pkc.PACKED_CONTENT_TYPE}) == b"not a message"
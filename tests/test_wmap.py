@@ -3,12 +3,19 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 #
 # Copyright 2024 Robert D. French
+import base64
+import concurrent.futures
+import dataclasses
 import os
 from pathlib import Path
 import pytest
+import socket
 import subprocess
 import tempfile
+import threading
+import time
 import json
+import urllib.error
 from . import pkc
 
 
@@ -32,6 +39,17 @@ def ssh_private_key_path():
         yield private_key_path
 
 
+@pytest.fixture
+def key_cache(monkeypatch):
+    """
+    Give a test its own empty key cache in place of the shared one, so
+    that whatever keys it publishes are gone once it is done.
+    """
+    cache = pkc.KeyCache()
+    monkeypatch.setattr(pkc, "KEY_CACHE", cache)
+    yield cache
+
+
 def test_algorithm_parse():
     """
     Ensure that we can parse ssh key algorithm strings into SigningAlgorithm
@@ -213,3 +231,568 @@ def test_message_load():
         message = pkc.SignedMessage.load(f.name)
         assert message.profile == profile
         assert message.signature == signature
+
+
+class FakeProfile(pkc.Profile):
+    """
+    A Profile whose keys come from a list of canned responses instead of
+    from GitHub. Each response is a (text, etag) pair, as returned by
+    Profile.fetch_authorized_keys, or an exception to raise.
+    """
+    def __init__(self, username, responses):
+        super().__init__(username)
+        self.responses = list(responses)
+        self.etags = []
+
+    def fetch_authorized_keys(self, etag=""):
+        self.etags.append(etag)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def test_key_cache_hit():
+    """
+    Show that a user's keys are only fetched once within the TTL.
+    """
+    cache = pkc.KeyCache(ttl=60)
+    profile = FakeProfile("alice", [("ssh-ed25519 abc", "v1")])
+    assert cache.get(profile) == "ssh-ed25519 abc"
+    assert cache.get(profile) == "ssh-ed25519 abc"
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_key_cache_revalidate():
+    """
+    Show that a stale entry is revalidated with its ETag, and that a
+    "Not Modified" response keeps the keys we already had.
+    """
+    cache = pkc.KeyCache(ttl=0)
+    profile = FakeProfile("alice", [
+        ("ssh-ed25519 abc", "v1"),
+        (None, "v1"),
+        ("ssh-ed25519 def", "v2")])
+    assert cache.get(profile) == "ssh-ed25519 abc"
+    assert cache.get(profile) == "ssh-ed25519 abc"
+    assert cache.get(profile) == "ssh-ed25519 def"
+    assert profile.etags == ["", "v1", "v1"]
+    assert cache.stats()['revalidations'] == 1
+
+
+def test_key_cache_eviction():
+    """
+    Show that the least recently used user is forgotten first.
+    """
+    cache = pkc.KeyCache(max_entries=2)
+    cache.put("a", "ssh-ed25519 a")
+    cache.put("b", "ssh-ed25519 b")
+    cache.get(FakeProfile("a", []))
+    cache.put("c", "ssh-ed25519 c")
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_key_cache_remembers_missing_users():
+    """
+    Show that users whom GitHub doesn't know, or who have no keys we
+    can check signatures with, are not looked up again for a while.
+    """
+    cache = pkc.KeyCache(ttl=0)
+    missing = urllib.error.HTTPError("", 404, "Not Found", None, None)
+    unknown = FakeProfile("nobody", [missing])
+    with pytest.raises(urllib.error.HTTPError):
+        cache.get(unknown)
+    with pytest.raises(pkc.NoUsableKeys):
+        cache.get(unknown)
+    ecdsa = FakeProfile("ecdsa", [("ecdsa-sha2-nistp256 abc", "v1")])
+    assert cache.get(ecdsa) == "ecdsa-sha2-nistp256 abc"
+    assert not cache.usable("ecdsa")
+    assert cache.stats()['missing'] == 2
+    cache.missing_ttl = 0
+    assert cache.usable("nobody")
+    broken = FakeProfile("broken", [
+        urllib.error.HTTPError("", 500, "Oops", None, None)])
+    with pytest.raises(urllib.error.HTTPError):
+        cache.get(broken)
+    assert cache.stats()['missing'] == 2
+    small = pkc.KeyCache(max_entries=1)
+    small.mark_missing("a")
+    small.mark_missing("b")
+    assert list(small.missing) == ["b"]
+
+
+class SlowProfile(FakeProfile):
+    """
+    A FakeProfile which waits for `release` to be set before answering,
+    so that tests can pile up several requests for the same keys.
+    """
+    def __init__(self, username, responses):
+        super().__init__(username, responses)
+        self.release = threading.Event()
+
+    def fetch_authorized_keys(self, etag=""):
+        self.release.wait(5)
+        return super().fetch_authorized_keys(etag)
+
+
+def test_key_cache_coalesces_fetches():
+    """
+    Show that when several threads want the same user's keys at once,
+    GitHub is only asked once, and every thread gets the same answer
+    (or the same error).
+    """
+    cache = pkc.KeyCache(ttl=60)
+    profile = SlowProfile("alice", [("ssh-ed25519 abc", "v1")])
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(cache.get, profile) for _ in range(4)]
+        while cache.stats()['coalesced'] < 3:
+            time.sleep(0.01)
+        profile.release.set()
+        assert [f.result() for f in futures] == ["ssh-ed25519 abc"] * 4
+    assert profile.etags == [""]
+    assert not cache.inflight
+
+    broken = SlowProfile("broken", [
+        urllib.error.HTTPError("", 500, "Oops", None, None)])
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(cache.get, broken) for _ in range(2)]
+        while cache.stats()['coalesced'] < 4:
+            time.sleep(0.01)
+        broken.release.set()
+        for future in futures:
+            with pytest.raises(urllib.error.HTTPError):
+                future.result()
+    assert not cache.inflight
+
+
+def test_key_cache_persistence():
+    """
+    Show that a cache backed by a file starts warm in a new process.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d) / "keys.json"
+        pkc.KeyCache(path=path).put("alice", "ssh-ed25519 abc", "v1")
+        cache = pkc.KeyCache(path=path)
+        assert cache.get(FakeProfile("alice", [])) == "ssh-ed25519 abc"
+        cache.clear()
+        assert cache.stats()['entries'] == 0
+
+
+def test_key_cache_flushes(tmp_path):
+    """
+    Show that a cache backed by a file saves itself at most every
+    `flush_interval` seconds, and whenever asked to, rather than on
+    every change.
+    """
+    path = tmp_path / "keys.json"
+    cache = pkc.KeyCache(path=path)
+    cache.put("alice", "ssh-ed25519 abc", "v1")
+    cache.put("bob", "ssh-ed25519 def", "v1")
+    assert list(json.loads(path.read_text())) == ["alice"]
+    cache.flush()
+    assert list(json.loads(path.read_text())) == ["alice", "bob"]
+    path.unlink()
+    cache.flush()
+    assert not path.exists()
+    cache.flush_interval = 0
+    cache.put("carol", "ssh-ed25519 ghi", "v1")
+    assert len(json.loads(path.read_text())) == 3
+
+
+def test_profile_authorized_keys_from_cache(key_cache):
+    """
+    Show that Profile.authorized_keys is served by the shared key cache.
+    """
+    key_cache.put("cached", "\n".join([
+        "ecdsa-sha2-nistp256 xyz789 phone",
+        "ssh-ed25519 abc123 laptop"]))
+    keys = pkc.Profile("cached").authorized_keys()
+    assert [k.material for k in keys] == ["abc123"]
+
+
+@pytest.fixture(params=['rsa', 'ed25519'])
+def signed_message(request, key_cache):
+    """
+    Sign a message with a temporary keypair, and publish that keypair's
+    public half in the key cache (as though it had come from GitHub).
+    Yields the signed message.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        key_path = os.path.join(temp_dir, "id")
+        subprocess.run([
+            'ssh-keygen', '-q', '-t', request.param, '-f', key_path, '-N', ''
+        ], check=True)
+        username = f"signer-{request.param}"
+        with open(key_path + ".pub") as f:
+            key_cache.put(username, f.read())
+        private_key = pkc.PrivateKey(pkc.Profile(username), key_path)
+        yield private_key.sign_data(b"Hello World!")
+
+
+def test_ssh_signature_parse(signed_message):
+    """
+    Show that we can pull apart an OpenSSH signature.
+    """
+    sig = signed_message.signature.parse()
+    assert sig.namespace == pkc.NAMESPACE
+    assert sig.hash_algorithm == "sha512"
+    with pytest.raises(Exception):
+        pkc.SSHSignature.parse("Hello World!")
+
+
+def test_verifier_agrees_with_ssh_keygen(signed_message):
+    """
+    Show that the verifier gives the same answer as ssh-keygen, both for
+    a genuine message and for one whose body has been tampered with.
+    """
+    verifier = pkc.Verifier()
+    forged = pkc.SignedMessage(
+        signed_message.profile, b"Goodbye World!", signed_message.signature)
+    assert verifier.verify_ssh_keygen(signed_message)
+    assert not verifier.verify_ssh_keygen(forged)
+    assert verifier.verify_batch([signed_message, forged]) == [True, False]
+
+
+def test_verifier_rsa_is_native(signed_message):
+    """
+    Show that RSA signatures are checked without running ssh-keygen, and
+    that Ed25519 signatures are too, unless cryptography isn't installed.
+    """
+    verifier = pkc.Verifier()
+    assert verifier.verify(signed_message)
+    if signed_message.profile.username == "signer-rsa" or verifier.ed25519:
+        assert verifier.stats() == {'native': 1, 'fallback': 0}
+    else:
+        assert verifier.stats() == {'native': 0, 'fallback': 1}
+
+
+def test_verifier_rejects_junk(key_cache):
+    """
+    Show that malformed signatures, signatures from other namespaces, and
+    signatures from keys which aren't on the author's profile are all
+    rejected.
+    """
+    key_cache.put("nobody", "")
+    verifier = pkc.Verifier()
+    junk = pkc.SignedMessage(
+        pkc.Profile("nobody"), b"b", pkc.Signature("c"))
+    assert verifier.verify_batch([junk]) == [False]
+    sig = pkc.Signature.load("tests/message.txt.sig")
+    with open("tests/message.txt", "rb") as f:
+        message = pkc.SignedMessage(pkc.Profile("nobody"), f.read(), sig)
+    assert not verifier.verify(message)
+
+
+def test_verifier_reports_errors_as_invalid(key_cache):
+    """
+    Show that a message which can't be verified at all (here, because the
+    author is known to have no usable keys) counts as invalid in a batch.
+    """
+    key_cache.mark_missing("weird")
+    sig = pkc.Signature.load("tests/message.txt.sig")
+    message = pkc.SignedMessage(pkc.Profile("weird"), b"b", sig)
+    assert pkc.Verifier().verify_batch([message]) == [False]
+
+
+def test_verifier_check_batch(key_cache):
+    """
+    Show that a message is only reported as invalid when its author
+    definitely has no key which could have signed it, and that one we
+    couldn't check because GitHub was down or unreachable is reported as
+    unknown (None) instead.
+    """
+    key_cache.configure(0, pkc.DEFAULT_KEY_CACHE_SIZE)
+    sig = pkc.Signature.load("tests/message.txt.sig")
+    profiles = [
+        FakeProfile("gone", [
+            urllib.error.HTTPError("", 404, "Not Found", None, None)]),
+        FakeProfile("ecdsa", [("ecdsa-sha2-nistp256 abc", "v1")]),
+        FakeProfile("down", [
+            urllib.error.HTTPError("", 502, "Bad Gateway", None, None)]),
+        FakeProfile("offline", [urllib.error.URLError("unreachable")]),
+    ]
+    messages = [pkc.SignedMessage(p, b"b", sig) for p in profiles]
+    verifier = pkc.Verifier()
+    assert verifier.check_batch(messages) == [False, False, None, None]
+    assert verifier.verify_batch(messages[2:]) == [False, False]
+
+
+def test_packed_signature(signed_message):
+    """
+    Show that a genuine signature is packed as its raw bytes, and comes
+    back exactly as it was, so the message keeps its id; and that a
+    signature which wouldn't come back exactly is left alone.
+    """
+    signature = signed_message.signature
+    raw = signature.raw()
+    assert raw.startswith(b"SSHSIG")
+    assert pkc.Signature.from_raw(raw) == signature
+    packed = signed_message.pack(compress=False)
+    flags = packed[len(pkc.PACKED_MAGIC)]
+    assert flags & pkc.PACKED_RAW_SIGNATURE
+    assert len(packed) < len(signed_message.dumps()) * 2 // 3
+    copy = pkc.SignedMessage.unpack(packed)
+    assert copy.digest() == signed_message.digest()
+    assert pkc.Verifier().verify(copy)
+
+    assert pkc.Signature("not base64!").raw() is None
+    armored = base64.b64decode(signature.content).decode()
+    rewrapped = armored.replace("\n", "\r\n")
+    odd = pkc.Signature(base64.b64encode(rewrapped.encode()).decode())
+    assert odd.raw() is None
+
+
+def test_verifier_audit(signed_message):
+    """
+    Show that an archived message is reported on by source, id and
+    author, and that a garbled one is reported as invalid, with a
+    reason, rather than raising.
+    """
+    verifier = pkc.Verifier()
+    report = verifier.audit("a.jsonl:1", signed_message.dumps().encode())
+    assert report == {
+        'source': "a.jsonl:1",
+        'id': signed_message.digest(),
+        'profile': signed_message.profile.username,
+        'valid': True
+    }
+    report = verifier.audit("a.jsonl:2", b"{not json")
+    assert report['source'] == "a.jsonl:2"
+    assert not report['valid']
+    assert report['error']
+
+
+def armor(sig, version=1, magic=b"SSHSIG"):
+    """
+    Turn an SSHSignature back into the text that ssh-keygen would write,
+    so that tests can build signatures with unusual contents.
+    """
+    pack = pkc.SSHBuffer.pack_string
+    blob = magic + version.to_bytes(4, 'big') + b"".join([
+        pack(sig.public_key),
+        pack(sig.namespace.encode()),
+        pack(sig.reserved),
+        pack(sig.hash_algorithm.encode()),
+        pack(sig.signature)])
+    text = "\n".join([
+        "-----BEGIN SSH SIGNATURE-----",
+        base64.b64encode(blob).decode(),
+        "-----END SSH SIGNATURE-----"])
+    return pkc.Signature(base64.b64encode(text.encode()).decode())
+
+
+def test_ssh_signature_parse_errors(signed_message):
+    """
+    Show that signatures with the wrong magic, the wrong version, or
+    missing fields are refused.
+    """
+    sig = signed_message.signature.parse()
+    assert armor(sig).parse() == sig
+    with pytest.raises(Exception):
+        armor(sig, magic=b"NOTSIG").parse()
+    with pytest.raises(Exception):
+        armor(sig, version=2).parse()
+    with pytest.raises(Exception):
+        pkc.SSHBuffer(b"\x00\x00\x00\x09abc").read_string()
+
+
+def test_verifier_checks_signature_fields(signed_message, key_cache):
+    """
+    Show that the verifier refuses signatures made for another namespace
+    or with an unexpected hash, and that it finds the right key among
+    several.
+    """
+    verifier = pkc.Verifier()
+    profile = signed_message.profile
+    body = signed_message.body
+    sig = signed_message.signature.parse()
+    other_namespace = dataclasses.replace(sig, namespace="other")
+    other_hash = dataclasses.replace(sig, hash_algorithm="md5")
+    for bad in [other_namespace, other_hash]:
+        message = pkc.SignedMessage(profile, body, armor(bad))
+        assert verifier.verify_native(message) is False
+    keys = key_cache.get(profile)
+    key_cache.put(profile.username, SHORT_RSA_KEY + "\n" + keys)
+    assert verifier.verify(signed_message)
+
+
+# An RSA public key which is too short for OpenSSH to accept, and a
+# "signature" from it that uses the legacy SHA-1 format.
+SHORT_RSA_KEY = "ssh-rsa " + base64.b64encode(
+    pkc.SSHBuffer.pack_string(b"ssh-rsa") +
+    pkc.SSHBuffer.pack_string(b"\x01\x00\x01") +
+    pkc.SSHBuffer.pack_string(b"\x7f" * 64)).decode()
+
+
+def test_verifier_rsa_edge_cases():
+    """
+    Show that short RSA keys are refused outright, and that SHA-1 RSA
+    signatures are left for ssh-keygen to judge.
+    """
+    verifier = pkc.Verifier()
+    key = pkc.AuthorizedKey.parse(SHORT_RSA_KEY).blob()
+    pack = pkc.SSHBuffer.pack_string
+    sha2 = pack(b"rsa-sha2-512") + pack(b"\x01")
+    sha1 = pack(b"ssh-rsa") + pack(b"\x01")
+    assert verifier.verify_rsa(key, sha2, b"data") is False
+    assert verifier.verify_rsa(key, sha1, b"data") is None
+
+
+def test_ssh_signature_armor(signed_message):
+    """
+    Show that we armor a signature exactly as ssh-keygen does.
+    """
+    text = base64.b64decode(signed_message.signature.content).decode()
+    assert pkc.SSHSignature.parse(text).armor() == text
+
+
+@pytest.fixture
+def ssh_agent():
+    """
+    Run a private ssh-agent for the duration of a test, and yield a
+    client for it.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        sock = os.path.join(temp_dir, "agent.sock")
+        agent = subprocess.Popen(
+            ['ssh-agent', '-D', '-a', sock], stdout=subprocess.DEVNULL)
+        while not os.path.exists(sock):
+            time.sleep(0.01)
+        client = pkc.SSHAgent(sock)
+        yield client
+        client.close()
+        agent.terminate()
+        agent.wait()
+
+
+@pytest.fixture(params=['rsa', 'ed25519'])
+def agent_key(request, ssh_agent, key_cache):
+    """
+    Create a keypair, publish it in the key cache and load it into the
+    agent. Yields a PrivateKey which signs with the agent.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        key_path = os.path.join(temp_dir, "id")
+        subprocess.run([
+            'ssh-keygen', '-q', '-t', request.param, '-f', key_path, '-N', ''
+        ], check=True)
+        subprocess.run(
+            ['ssh-add', '-q', key_path], check=True, stderr=subprocess.DEVNULL,
+            env={**os.environ, 'SSH_AUTH_SOCK': ssh_agent.path})
+        username = f"agent-{request.param}"
+        with open(key_path + ".pub") as f:
+            key_cache.put(username, f.read())
+        yield pkc.PrivateKey(pkc.Profile(username), key_path, ssh_agent)
+
+
+def test_agent_signing(agent_key):
+    """
+    Show that signatures made through ssh-agent are accepted by
+    ssh-keygen, without falling back to ssh-keygen to make them.
+    """
+    message = agent_key.sign_data(b"Hello World!")
+    assert agent_key.agent is not None
+    assert pkc.Verifier().verify_ssh_keygen(message)
+    assert message.signature.parse().hash_algorithm == "sha512"
+    assert pkc.Verifier().verify(message)
+
+
+def test_agent_sign_many(agent_key):
+    messages = agent_key.sign_many([b"a", b"b", b"c"])
+    assert [m.body for m in messages] == [b"a", b"b", b"c"]
+    assert all(pkc.Verifier().verify(m) for m in messages)
+    assert agent_key.agent is not None
+
+
+def test_agent_identities(agent_key):
+    agent_key.sign_data(b"")
+    assert agent_key.agent.identities() == [agent_key.public_key]
+
+
+def test_agent_reconnects(agent_key):
+    """
+    Show that if the agent connection goes away, we make a new one.
+    """
+    agent_key.sign_data(b"first")
+    agent_key.agent.sock.shutdown(socket.SHUT_RDWR)
+    agent_key.sign_data(b"second")
+    # This time, the request goes out but no reply comes back.
+    agent_key.agent.sock.shutdown(socket.SHUT_RD)
+    agent_key.sign_data(b"third")
+    assert agent_key.agent is not None
+
+
+def test_agent_refusals(ssh_agent, signed_message, monkeypatch):
+    """
+    Show that an agent refusing a request is reported as an error.
+    """
+    key = signed_message.signature.parse().public_key
+    with pytest.raises(Exception, match="refused"):
+        ssh_agent.sign(key, b"data")
+    monkeypatch.setattr(
+        ssh_agent, "request", lambda kind, payload: (ssh_agent.FAILURE, b""))
+    with pytest.raises(Exception, match="list"):
+        ssh_agent.identities()
+
+
+def test_agent_fallback(ssh_agent, ssh_private_key_path):
+    """
+    Show that if the agent doesn't hold our key, we sign with
+    ssh-keygen instead, and stop asking the agent.
+    """
+    private_key = pkc.PrivateKey(
+        pkc.Profile("example"), ssh_private_key_path, ssh_agent)
+    messages = private_key.sign_many([b"a", b"b"])
+    assert private_key.agent is None
+    assert [m.body for m in messages] == [b"a", b"b"]
+    assert all(m.signature.parse().namespace == pkc.NAMESPACE
+               for m in messages)
+    assert private_key.sign_many([]) == []
+
+
+def test_agent_without_public_key(ssh_agent, tmp_path):
+    """
+    Show that without the public half of our key, we can't ask the
+    agent for anything, and stop trying.
+    """
+    private_key = pkc.PrivateKey(
+        pkc.Profile("example"), tmp_path / "missing", ssh_agent)
+    assert private_key.sign_with_agent(b"a") is None
+    assert private_key.agent is None
+
+
+def test_agent_unreachable(ssh_private_key_path, monkeypatch):
+    monkeypatch.setenv("SSH_AUTH_SOCK", "/nonexistent/agent.sock")
+    private_key = pkc.PrivateKey(pkc.Profile("example"), ssh_private_key_path)
+    assert private_key.agent.path == "/nonexistent/agent.sock"
+    with pytest.raises(OSError):
+        private_key.agent.identities()
+    assert private_key.sign_with_agent(b"a") is None
+    assert private_key.agent is None
+    monkeypatch.delenv("SSH_AUTH_SOCK")
+    assert pkc.PrivateKey(pkc.Profile("a"), "b").agent is None
+
+
+def test_agent_transient_errors(agent_key, monkeypatch):
+    """
+    Show that a passing failure of the agent doesn't stop us from using
+    it: we ask again, and only a refused connection makes us give up.
+    """
+    sign = agent_key.agent.sign
+    failures = [ConnectionError("ssh-agent hung up")]
+
+    def flaky(*args):
+        if failures:
+            raise failures.pop()
+        return sign(*args)
+    monkeypatch.setattr(agent_key.agent, "sign", flaky)
+    assert agent_key.sign_with_agent(b"a") is not None
+    failures.extend([socket.timeout(), socket.timeout()])
+    assert agent_key.sign_with_agent(b"b") is None
+    assert agent_key.agent is not None
+    message = agent_key.sign_data(b"c")
+    assert pkc.Verifier().verify(message)
+    failures.append(ConnectionRefusedError())
+    assert agent_key.sign_with_agent(b"d") is None
+    assert agent_key.agent is None